@@ -1,101 +1,1121 @@
 #!/usr/bin/env python
 
-from collections import defaultdict
+import os
+import re
+import gc
+import sys
+import mmap
+import random
+import zlib
+import Queue
+import shutil
+import struct
+import hashlib
+import threading
+import multiprocessing
+from array import array
+from itertools import chain
+from collections import defaultdict, namedtuple, Mapping, MutableMapping
+import numpy as np
+
+# A protein of a fasta file, see iter_records
+FastaRecord = namedtuple('FastaRecord', ['protein', 'gene', 'sequence'])
+
+# A line of a faidx-style index: name, number of residues, byte offset of the sequence, and residues and bytes
+# per line (of the first sequence line)
+FaiEntry = namedtuple('FaiEntry', ['name', 'length', 'offset', 'linebases', 'linewidth'])
+
+# Cleavage rule of an enzyme: it cuts at the residues in cleave, on the C- or N-terminal side (side 'C' or 'N'),
+# except when the residue on the other side of the bond is in restrict
+Enzyme = namedtuple('Enzyme', ['cleave', 'restrict', 'side'])
+
+ENZYMES = {'trypsin': Enzyme('KR', 'P', 'C'),
+           'trypsin/p': Enzyme('KR', '', 'C'),
+           'lys-c': Enzyme('K', 'P', 'C'),
+           'lys-n': Enzyme('K', '', 'N'),
+           'arg-c': Enzyme('R', 'P', 'C'),
+           'asp-n': Enzyme('D', '', 'N'),
+           'glu-c': Enzyme('E', 'P', 'C'),
+           'chymotrypsin': Enzyme('FWYL', 'P', 'C')}
+
+# Peptides of a digest, as arrays with one element per peptide. buffer holds the sequences of the proteins
+# separated by newlines, the sequence of protein i starts at protein_offsets[i], and peptide j is
+# buffer[start[j]:end[j]] of proteins[protein[j]], with missed_cleavages[j] missed cleavage sites
+Digest = namedtuple('Digest', ['proteins', 'buffer', 'protein_offsets', 'protein', 'start', 'end',
+                               'missed_cleavages'])
+
+# Occurrences of peptides in proteins, see PeptideMapper.map: occurrence i is peptides[peptide[i]] at the 0-based
+# position[i] of proteins[protein[i]]
+PeptideMatches = namedtuple('PeptideMatches', ['peptides', 'proteins', 'peptide', 'protein', 'position'])
+
+
+def header_gene(header, ensembl=False):
+    '''Take a fasta header line, and output the gene name (gene:<name>) if ensembl is True, otherwise N/A'''
+    if ensembl:
+        return [word[5:] for word in header.split() if word.find('gene:') == 0][0]
+    return 'N/A'
+
+
+def compression(pathname):
+    '''Output 'bgzf' for a block gzipped (bgzip) file, 'gzip' for another gzipped file, or None'''
+    with open(pathname, 'rb') as infile:
+        header = infile.read(16)
+    if header[:2] != '\x1f\x8b':
+        return None
+    # BGZF blocks have an extra field (flag 4) with the subfield BC
+    if len(header) == 16 and ord(header[3]) & 4 and header[12:14] == 'BC':
+        return 'bgzf'
+    return 'gzip'
+
+
+class BackgroundReader():
+    '''Iterable of the lines of a gzipped (or BGZF) file, decompressed in a separate thread, so that decompression
+    overlaps with parsing. The thread stops when the iteration ends, is closed early, or close is called'''
+
+    def __init__(self, pathname, max_chunks=64, chunk_size=1 << 20):
+        self.pathname = pathname
+        self.chunk_size = chunk_size
+        self.queue = Queue.Queue(max_chunks)  # Bounded, so the memory stays flat if the parsing is slow
+        self.stopped = threading.Event()
+        self.error = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, data):
+        '''Put data on the queue, waiting while it is full, and output False if the reader was closed meanwhile'''
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(data, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def run(self):
+        '''Put decompressed chunks on the queue, and None at the end'''
+        try:
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            with open(self.pathname, 'rb') as infile:
+                for block in iter(lambda: infile.read(self.chunk_size), ''):
+                    while block:
+                        data = decompressor.decompress(block)
+                        if data and not self.put(data):
+                            return
+                        # A gzip file can have several members (BGZF has one per block)
+                        block = decompressor.unused_data
+                        if block:
+                            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            data = decompressor.flush()
+            if data:
+                self.put(data)
+        except Exception as error:
+            self.error = error  # Raised in the main thread at the end of the iteration
+        finally:
+            self.put(None)
+
+    def close(self):
+        '''Stop the thread, and drop the chunks it has decompressed'''
+        self.stopped.set()
+        self.thread.join()
+        while not self.queue.empty():
+            self.queue.get()
+
+    def __iter__(self):
+        rest = ''
+        try:
+            while True:
+                data = self.queue.get()
+                if data is None:
+                    break
+                lines = (rest + data).splitlines(True)
+                rest = lines.pop() if not lines[-1].endswith('\n') else ''
+                for line in lines:
+                    yield line
+        finally:
+            # Also when the iteration is abandoned, and the generator is closed
+            self.close()
+        if self.error is not None:
+            raise self.error
+        if rest:
+            yield rest
+
+
+def open_fasta(pathname):
+    '''Output an iterable of the lines of a plain, gzipped or BGZF fasta file'''
+    if compression(pathname) is None:
+        return open(pathname, 'rb')
+    return BackgroundReader(pathname)
+
+
+def iter_records(pathname, ensembl=False):
+    '''
+    Yield a FastaRecord for each protein of a fasta file, in file order. Only one protein is held in memory,
+    so huge fasta files can be streamed in a single pass. Gzipped and BGZF files are decompressed in a
+    background thread.
+    '''
+    return parse_records(open_fasta(pathname), ensembl)
+
+
+def parse_records(lines, ensembl=False):
+    '''Yield a FastaRecord for each protein in lines of fasta, see iter_records'''
+    for header, sequence in parse_entries(lines):
+        yield FastaRecord(header.split()[0][1:], header_gene(header, ensembl), sequence)
+
+
+def parse_entries(lines):
+    '''Yield (header line without line break, sequence) for each protein in lines of fasta'''
+    header = None
+    lines_of_protein = []
+    for line in lines:
+        if line[0] == '>':
+            if header is not None:
+                yield header, ''.join(lines_of_protein)
+            header = line.rstrip('\r\n')
+            lines_of_protein = []
+        else:
+            lines_of_protein.append(line.strip())
+    if header is not None:
+        yield header, ''.join(lines_of_protein)
+
+
+def split_fasta(pathname, num_chunks):
+    '''Output (start, end) byte offsets that split a fasta file in at most num_chunks parts, at record boundaries'''
+    size = os.path.getsize(pathname)
+    bounds = [0]
+    with open(pathname, 'rb') as fasta_file:
+        for i in range(1, num_chunks):
+            fasta_file.seek(max(size * i // num_chunks - 1, bounds[-1]))
+            fasta_file.readline()  # The rest of the current line
+            while True:
+                offset = fasta_file.tell()
+                line = fasta_file.readline()
+                if not line or line[0] == '>':
+                    break
+            if bounds[-1] < offset < size:
+                bounds.append(offset)
+    bounds.append(size)
+    return zip(bounds[:-1], bounds[1:])
+
+
+def parse_chunk(arguments):
+    '''Take (pathname, start, end, ensembl), and output the list of FastaRecord from start to end of the file'''
+    pathname, start, end, ensembl = arguments
+    with open(pathname, 'rb') as fasta_file:
+        fasta_file.seek(start)
+        chunk = fasta_file.read(end - start)
+    return list(parse_records(chunk.splitlines(True), ensembl))
+
+
+def trypsinize_chunk(arguments):
+    '''
+    Take (sequences, min_len, max_len), where sequences is a dict from protein to sequence, and output the list of
+    proteins, a fixed width array of their tryptic peptides and an array of the protein index of each peptide
+    '''
+    sequences, min_len, max_len = arguments
+    tryptic = digest(sequences, 'trypsin', 0, min_len, max_len)
+    return tryptic.proteins, peptide_array(tryptic), tryptic.protein
+
+
+def split_list(values, offsets):
+    '''Output the list of lists values[offsets[i]:offsets[i+1]]'''
+    return [values[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def group_pairs(keys, values, num_values):
+    '''
+    Take aligned integer arrays, and output the CSR offsets (by key, with max(keys) + 1 rows) and the unique
+    values of each key, in increasing order
+    '''
+    num_values = max(num_values, 1)
+    pairs = np.unique(keys.astype(np.int64) * num_values + values)
+    counts = np.bincount(pairs // num_values, minlength=int(keys.max()) + 1 if len(keys) else 0)
+    return np.concatenate(([0], np.cumsum(counts))).astype(np.int64), pairs % num_values
+
+
+def build_index(pathname):
+    '''Scan a fasta file once, and output a list of FaiEntry, one per protein (offsets are uncompressed for BGZF)'''
+    entries = []
+    offset = 0
+    name = None
+    for line in open_fasta(pathname):
+        if line[0] == '>':
+            if name is not None:
+                entries.append(FaiEntry(name, length, start, linebases, linewidth))
+            name = line.split()[0][1:]
+            length = linebases = linewidth = 0
+            start = offset + len(line)
+        else:
+            bases = len(line.strip())
+            if linewidth == 0 and bases:
+                linebases, linewidth = bases, len(line)
+            length += bases
+        offset += len(line)
+    if name is not None:
+        entries.append(FaiEntry(name, length, start, linebases, linewidth))
+    return entries
+
+
+def write_index(entries, index_path):
+    '''Write a list of FaiEntry as a tab-delimited faidx-style index'''
+    with open(index_path, 'w') as index_file:
+        for entry in entries:
+            index_file.write('%s\t%d\t%d\t%d\t%d\n' % entry)
+
+
+def read_index(index_path):
+    '''Read a faidx-style index, and output a list of FaiEntry'''
+    entries = []
+    for line in open(index_path):
+        name, length, offset, linebases, linewidth = line.rstrip('\r\n').split('\t')[:5]
+        entries.append(FaiEntry(name, int(length), int(offset), int(linebases), int(linewidth)))
+    return entries
+
+
+def load_index(pathname, index_path=None):
+    '''
+    Output the index of a fasta file. The index is read from index_path (default <pathname>.fai) if it is newer
+    than the fasta file, otherwise it is built and stored there (if the directory is writable).
+    '''
+    if index_path is None:
+        index_path = pathname + '.fai'
+    if os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(pathname):
+        return read_index(index_path)
+    entries = build_index(pathname)
+    try:
+        write_index(entries, index_path)
+    except (IOError, OSError):
+        pass
+    return entries
+
+
+def build_gzi(pathname):
+    '''
+    Scan the block headers of a BGZF file, and output a list of (compressed offset, uncompressed offset) of each
+    block, and the uncompressed size
+    '''
+    blocks = []
+    compressed = uncompressed = 0
+    with open(pathname, 'rb') as infile:
+        while True:
+            header = infile.read(18)
+            if len(header) < 18:
+                break
+            if header[:4] != '\x1f\x8b\x08\x04' or header[12:14] != 'BC':
+                raise ValueError('%s is not block gzipped (bgzip) at byte %d' % (pathname, compressed))
+            block_size = struct.unpack('<H', header[16:18])[0] + 1
+            infile.seek(compressed + block_size - 4)
+            blocks.append((compressed, uncompressed))
+            compressed += block_size
+            uncompressed += struct.unpack('<I', infile.read(4))[0]
+            infile.seek(compressed)
+    return blocks, uncompressed
+
+
+def write_gzi(blocks, gzi_path):
+    '''Write the blocks of build_gzi as a .gzi index, like bgzip -i (without the first block)'''
+    with open(gzi_path, 'wb') as gzi_file:
+        gzi_file.write(struct.pack('<Q', len(blocks) - 1))
+        for compressed, uncompressed in blocks[1:]:
+            gzi_file.write(struct.pack('<QQ', compressed, uncompressed))
+
+
+def read_gzi(gzi_path):
+    '''Read a .gzi index, and output the list of (compressed offset, uncompressed offset) of each block'''
+    with open(gzi_path, 'rb') as gzi_file:
+        count = struct.unpack('<Q', gzi_file.read(8))[0]
+        values = struct.unpack('<%dQ' % (2 * count), gzi_file.read(16 * count))
+    return [(0, 0)] + zip(values[::2], values[1::2])
+
+
+class BgzfReader():
+    '''
+    Random access to the uncompressed content of a BGZF file, by slicing and by find and rfind of a single
+    character, like the mmap of a plain file. The block index is read from gzi_path (default <pathname>.gzi) if it
+    is newer than the file, otherwise it is built and stored there, and recently used blocks are cached.
+    '''
+
+    def __init__(self, pathname, gzi_path=None, cache_blocks=64):
+        gzi_path = gzi_path or '%s.gzi' % (pathname)
+        if os.path.exists(gzi_path) and os.path.getmtime(gzi_path) >= os.path.getmtime(pathname):
+            blocks = read_gzi(gzi_path)
+        else:
+            blocks = build_gzi(pathname)[0]
+            try:
+                write_gzi(blocks, gzi_path)
+            except (IOError, OSError):
+                pass
+        self.infile = open(pathname, 'rb')
+        # The compressed offsets end with the file size, and the uncompressed with the uncompressed size
+        file_size = os.path.getsize(pathname)
+        self.infile.seek(file_size - 4)
+        last_size = struct.unpack('<I', self.infile.read(4))[0]
+        self.compressed = np.array([block[0] for block in blocks] + [file_size], dtype=np.int64)
+        self.uncompressed = np.array([block[1] for block in blocks] + [blocks[-1][1] + last_size], dtype=np.int64)
+        self.cache_blocks = cache_blocks
+        self.cache = {}
+
+    def block(self, i):
+        '''Output the uncompressed content of block i'''
+        if i not in self.cache:
+            if len(self.cache) >= self.cache_blocks:
+                self.cache.clear()
+            self.infile.seek(int(self.compressed[i]))
+            self.cache[i] = zlib.decompress(self.infile.read(int(self.compressed[i + 1] - self.compressed[i])),
+                                            16 + zlib.MAX_WBITS)
+        return self.cache[i]
+
+    def block_of(self, offset):
+        '''Output the index of the block with an uncompressed offset'''
+        return int(np.searchsorted(self.uncompressed, offset, side='right')) - 1
+
+    def __len__(self):
+        return int(self.uncompressed[-1])
+
+    def __getitem__(self, key):
+        start, stop, step = key.indices(len(self))
+        if stop <= start:
+            return ''
+        first, last = self.block_of(start), self.block_of(stop - 1)
+        data = ''.join([self.block(i) for i in range(first, last + 1)])
+        return data[start - self.uncompressed[first]:stop - self.uncompressed[first]]
+
+    def find(self, character, start=0):
+        '''Output the first offset of a character from start, or -1'''
+        for i in range(max(self.block_of(start), 0), len(self.uncompressed) - 1):
+            position = self.block(i).find(character, max(start - self.uncompressed[i], 0))
+            if position != -1:
+                return int(self.uncompressed[i]) + position
+        return -1
+
+    def rfind(self, character, start, end):
+        '''Output the last offset of a character from start to end, or -1'''
+        for i in range(self.block_of(end - 1), max(self.block_of(start), 0) - 1, -1):
+            first = int(self.uncompressed[i])
+            position = self.block(i).rfind(character, max(start - first, 0), end - first)
+            if position != -1:
+                return first + position
+        return -1
+
+
+def residue_table(residues):
+    '''Output a boolean array over all byte values, True for the residues'''
+    table = np.zeros(256, dtype=bool)
+    table[[ord(aa) for aa in residues]] = True
+    return table
+
+
+def digest_batch(residues, starts, ends, enzyme, missed_cleavages, min_len, max_len, semi_specific, remove_met):
+    '''
+    Digest the proteins in residues (a uint8 array of sequences separated by newlines) from starts to ends, and
+    output arrays of the starts, ends and missed cleavages of the peptides, see digest
+    '''
+    if len(residues) < 2:
+        residues = np.zeros(2, dtype=np.uint8)  # No bonds
+    # Cleavage sites, where site i is the bond before residue i
+    before, after = residues[:-1], residues[1:]
+    if enzyme.side == 'C':
+        is_site = residue_table(enzyme.cleave)[before] & ~residue_table(enzyme.restrict)[after]
+    else:
+        is_site = residue_table(enzyme.cleave)[after] & ~residue_table(enzyme.restrict)[before]
+    is_site &= (before != ord('\n')) & (after != ord('\n'))
+    is_site = np.concatenate(([False], is_site))
+    # Bounds of the specific peptides, and the protein and index of the first and last bound in the protein of
+    # each bound
+    bounds = np.union1d(np.flatnonzero(is_site), np.concatenate((starts, ends)))
+    bound_proteins = np.searchsorted(starts, bounds, side='right') - 1
+    last_bounds = np.searchsorted(bounds, ends)[bound_proteins]
+    first_bounds = np.searchsorted(bounds, starts)[bound_proteins]
+    indices = np.arange(len(bounds))
+    peptide_starts = []
+    peptide_ends = []
+    for k in range(1, missed_cleavages + 2):
+        same = bound_proteins[:-k] == bound_proteins[k:]
+        peptide_starts.append(bounds[:-k][same])
+        peptide_ends.append(bounds[k:][same])
+    # Specific N-termini, with the index of the furthest bound a peptide from them may end at
+    left = bounds
+    left_last = np.minimum(indices + missed_cleavages + 1, last_bounds)
+    if remove_met and len(starts):
+        met = (ends - starts > 1) & (residues[np.minimum(starts, len(residues) - 1)] == ord('M'))
+        first = np.searchsorted(bounds, starts[met])
+        met_last = np.minimum(first + missed_cleavages + 1, np.searchsorted(bounds, ends[met]))
+        for k in range(1, missed_cleavages + 2):
+            inside = first + k <= met_last
+            peptide_starts.append(starts[met][inside] + 1)
+            peptide_ends.append(bounds[np.minimum(first + k, len(bounds) - 1)][inside])
+        left = np.concatenate((left, starts[met] + 1))
+        left_last = np.concatenate((left_last, met_last))
+    if semi_specific:
+        # Prefixes of the longest peptide from each specific N-terminus, and suffixes of the longest peptide to
+        # each specific C-terminus
+        for fixed, other, sign in ((left, bounds[left_last], 1),
+                                   (bounds, bounds[np.maximum(indices - missed_cleavages - 1, first_bounds)], -1)):
+            longest = np.minimum(np.abs(other - fixed) - 1, max_len)
+            counts = np.maximum(longest - min_len + 1, 0)
+            offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + min_len
+            fixed = np.repeat(fixed, counts)
+            if sign == 1:
+                peptide_starts.append(fixed)
+                peptide_ends.append(fixed + offsets)
+            else:
+                peptide_starts.append(fixed - offsets)
+                peptide_ends.append(fixed)
+    peptide_starts = np.concatenate(peptide_starts).astype(np.int64)
+    peptide_ends = np.concatenate(peptide_ends).astype(np.int64)
+    peptide_lengths = peptide_ends - peptide_starts
+    keep = (peptide_lengths >= min_len) & (peptide_lengths <= max_len)
+    pairs = np.unique(peptide_starts[keep] * (len(residues) + 1) + peptide_ends[keep])
+    peptide_starts, peptide_ends = pairs // (len(residues) + 1), pairs % (len(residues) + 1)
+    site_counts = np.cumsum(is_site)
+    missed = site_counts[np.maximum(peptide_ends - 1, 0)] - site_counts[peptide_starts]
+    return peptide_starts, peptide_ends, missed.astype(np.int32)
+
+
+def digest(sequences, enzyme='trypsin', missed_cleavages=0, min_len=6, max_len=40, semi_specific=False,
+           remove_met=False, batch_size=1000000):
+    '''
+    Digest the sequences of a dict from protein to sequence (e.g. Fasta.proteins) in bulk, and output a Digest.
+    The enzyme is a name in ENZYMES or an Enzyme. Peptides have at most missed_cleavages missed cleavage sites
+    and min_len to max_len residues. With semi_specific, peptides where only one end follows the cleavage rule are
+    included, and with remove_met, peptides starting after the N-terminal methionine of a protein are included.
+    The peptides are ordered by protein and position, each (protein, start, end) once. The proteins are digested in
+    batches of about batch_size residues, to bound the memory of the intermediate arrays.
+    '''
+    if not isinstance(enzyme, Enzyme):
+        enzyme = ENZYMES[enzyme.lower()]
+    proteins = list(sequences)
+    lengths = np.array([len(sequences[protein]) for protein in proteins], dtype=np.int64)
+    starts = np.cumsum(lengths + 1) - (lengths + 1)
+    ends = starts + lengths
+    buffer = '\n'.join([sequences[protein] for protein in proteins])
+    residues = np.frombuffer(buffer, dtype=np.uint8) if buffer else np.zeros(0, dtype=np.uint8)
+    batches = np.unique(np.concatenate(([0], np.flatnonzero(np.diff(starts // batch_size)) + 1, [len(proteins)])))
+    peptide_starts = [np.zeros(0, dtype=np.int64)]
+    peptide_ends = [np.zeros(0, dtype=np.int64)]
+    missed = [np.zeros(0, dtype=np.int32)]
+    for first, last in zip(batches[:-1], batches[1:]):
+        offset = starts[first]
+        batch = digest_batch(residues[offset:ends[last - 1]], starts[first:last] - offset,
+                             ends[first:last] - offset, enzyme, missed_cleavages, min_len, max_len, semi_specific,
+                             remove_met)
+        peptide_starts.append(batch[0] + offset)
+        peptide_ends.append(batch[1] + offset)
+        missed.append(batch[2])
+    peptide_starts = np.concatenate(peptide_starts)
+    return Digest(proteins, buffer, starts,
+                  (np.searchsorted(starts, peptide_starts, side='right') - 1).astype(np.int32), peptide_starts,
+                  np.concatenate(peptide_ends), np.concatenate(missed))
+
+
+def peptide_sequences(digest):
+    '''Output the list of peptide sequences of a Digest'''
+    buffer = digest.buffer
+    return [buffer[start:end] for start, end in zip(digest.start.tolist(), digest.end.tolist())]
+
+
+class IndexedSequences(MutableMapping):
+    '''
+    Dictionary from protein to sequence, where the sequences are read lazily from a memory mapped fasta file (or a
+    BGZF file, through a BgzfReader). Assigned values (e.g. the peptide lists of Fasta.trypsinize) are kept in memory instead.
+    '''
+
+    def __init__(self, pathname, entries):
+        self.pathname = pathname
+        self.index = dict((entry.name, entry) for entry in entries)
+        self.names = [entry.name for entry in entries if self.index[entry.name] is entry]  # File order, last wins
+        self.assigned = {}
+        self.mm = None
+        compressed = compression(pathname)
+        if compressed == 'bgzf':
+            self.mm = BgzfReader(pathname)
+        elif compressed == 'gzip':
+            raise ValueError('%s is gzipped, but not block gzipped (bgzip), so it can only be read sequentially'
+                             % (pathname))
+        elif os.path.getsize(pathname) > 0:
+            with open(pathname, 'rb') as fasta_file:
+                self.mm = mmap.mmap(fasta_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def get_sequence(self, protein):
+        '''Read the sequence of a protein from the fasta file'''
+        entry = self.index[protein]
+        if entry.length == 0:
+            return ''
+        end = self.mm.find('>', entry.offset)
+        if end == -1:
+            end = len(self.mm)
+        return self.mm[entry.offset:end].translate(None, ' \t\r\n')
+
+    def get_header(self, protein):
+        '''Read the header line of a protein from the fasta file'''
+        offset = self.index[protein].offset
+        return self.mm[self.mm.rfind('>', 0, offset):offset]
+
+    def __getitem__(self, protein):
+        if protein in self.assigned:
+            return self.assigned[protein]
+        return self.get_sequence(protein)
+
+    def __setitem__(self, protein, value):
+        if protein not in self.index:
+            raise KeyError('%s is not in %s' % (protein, self.pathname))
+        self.assigned[protein] = value
+
+    def __delitem__(self, protein):
+        del self.index[protein]
+        self.names.remove(protein)
+        self.assigned.pop(protein, None)
+
+    def __contains__(self, protein):
+        return protein in self.index
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
 
 class Fasta():
     '''Imports a fasta file, and stores proteins and genes in dict'''
 
-    def __init__(self, pathname, unique_proteins=False, ensembl=False):
+    def __init__(self, pathname, unique_proteins=False, ensembl=False, indexed=False, index_path=None,
+                 processes=1, verify_duplicates=False):
         '''Reads and stores the proteins'''
         '''If unique_proteins is True, identical proteins are stored as one'''
+        '''
+        Identical proteins are found by an md5 digest of the sequences, if verify_duplicates is True, the sequences
+        with the same digest are also compared
+        '''
+        '''
+        If indexed is True, only a faidx-style index (see load_index) is held in memory, and the sequences are read
+        from the memory mapped file when they are looked up in self.proteins
+        '''
+        '''
+        If processes > 1, chunks of the file (split at records) are parsed in a pool of processes. Gzipped and BGZF
+        files are instead decompressed in a background thread, while the records are parsed.
+        '''
         self.proteins = {}  # Protein to sequence (or protein to list if trypsinize has been run)
         self.genes = defaultdict(list)     # Genes to list of proteins
         self.protein_to_gene_dict = {}
-        self.previous_sequences = {}  # To check whether a given protein is identical to previous protein
+        self.previous_sequences = {}  # Digest of each stored sequence to its protein's index in self.protein_list
+        self.digest_collisions = {}  # Digest to the indices of later stored proteins with the digest, if verified
+        self.verify_duplicates = verify_duplicates
+        self.protein_list = []  # All proteins with a sequence, in file order
+        self.representatives = array('i')  # Index in protein_list of the first protein with the same sequence
+        if indexed:
+            self.load_indexed(pathname, unique_proteins, ensembl, index_path)
+        else:
+            self.load(pathname, unique_proteins, ensembl, processes)
+        self.representatives = np.frombuffer(self.representatives, dtype=np.int32)
+
+
+    def load(self, pathname, unique_proteins, ensembl, processes):
+        '''Read the fasta file, and store the proteins'''
         # Read fasta
-        sequence = ''
-        for line in open(pathname):
-            # Header line, first time (or when sequence is empty in fasta-file)
-            if line[0] == '>' and sequence == '':
-                # Obtain protein name
-                protein = line.split()[0][1:]
-                if ensembl:
-                    gene = [word[5:] for word in line.split() if word.find('gene:') == 0][0]
-                else:
-                    gene = 'N/A'
-                self.protein_to_gene_dict[protein] = gene
-            # Header line, other times
-            elif line[0] == '>' and sequence != '':
+        parallel = processes > 1 and compression(pathname) is None
+        if parallel:
+            pool = multiprocessing.Pool(processes)
+            chunks = [(pathname, start, end, ensembl) for start, end in split_fasta(pathname, processes * 4)]
+            records = chain.from_iterable(pool.imap(parse_chunk, chunks))
+        else:
+            records = iter_records(pathname, ensembl)
+        for protein, gene, sequence in records:
+            self.protein_to_gene_dict[protein] = gene
+            if sequence != '':
                 self.store_previous_protein(protein, gene, sequence, unique_proteins)
-                # Update values
-                sequence = ''
-                protein = line.split()[0][1:]
-                if ensembl:
-                    gene = [word[5:] for word in line.split() if word.find('gene:') == 0][0]
-                else:
-                    gene = 'N/A'
-                self.protein_to_gene_dict[protein] = gene
-            # Sequence line
+        if parallel:
+            pool.close()
+            pool.join()
+
+
+    def load_indexed(self, pathname, unique_proteins, ensembl, index_path):
+        '''Index the fasta file, and store the proteins as an IndexedSequences'''
+        self.proteins = IndexedSequences(pathname, load_index(pathname, index_path))
+        for protein in list(self.proteins):
+            gene = header_gene(self.proteins.get_header(protein), ensembl)
+            self.protein_to_gene_dict[protein] = gene
+            if self.proteins.index[protein].length == 0:
+                del self.proteins[protein]
+                continue
+            index = len(self.protein_list)
+            self.protein_list.append(protein)
+            if unique_proteins:
+                self.representatives.append(self.find_representative(self.proteins[protein], index))
             else:
-                sequence = ''.join([sequence, line.strip()])  # Should be fast... 
-        # Store the last protein of the fasta-file
-        self.store_previous_protein(protein, gene, sequence, unique_proteins)
+                self.representatives.append(index)
+            if self.representatives[-1] == index:
+                self.genes[gene].append(protein)
+            else:
+                del self.proteins[protein]
 
 
     def store_previous_protein(self, protein, gene, sequence, unique_proteins):
         '''Takes protein and gene names and aa-sequence, and boolean about how to treat repeated proteins'''
+        index = len(self.protein_list)
+        self.protein_list.append(protein)
         # Store previous protein, (if unique, store only new proteins)
-        if unique_proteins and sequence not in self.previous_sequences:
-            self.proteins[protein] = sequence
-            self.genes[gene].append(protein)
-            self.previous_sequences[sequence] = 1
-        # Identical protein sequence has already been stored, so pass
-        elif unique_proteins:
-            pass
+        if unique_proteins:
+            self.representatives.append(self.find_representative(sequence, index))
         # Or... store all proteins
         else:
+            self.representatives.append(index)
+        # Identical protein sequence has already been stored, so pass
+        if self.representatives[-1] == index:
             self.proteins[protein] = sequence
-            self.genes[gene].append(protein)  
+            self.genes[gene].append(protein)
+
+
+    def find_representative(self, sequence, index):
+        '''
+        Takes the sequence of protein_list[index], and outputs the index of the first protein with the same sequence
+        (index itself if there is none). Only the digests of the sequences are kept, the sequences of proteins with
+        the same digest are compared if verify_duplicates is True.
+        '''
+        digest = hashlib.md5(sequence).digest()
+        representative = self.previous_sequences.setdefault(digest, index)
+        if representative == index or not self.verify_duplicates:
+            return representative
+        # Compare with the stored proteins of the same digest
+        for representative in [representative] + self.digest_collisions.get(digest, []):
+            if self.proteins[self.protein_list[representative]] == sequence:
+                return representative
+        self.digest_collisions.setdefault(digest, []).append(index)
+        return index
+
+
+    def digest(self, enzyme='trypsin', missed_cleavages=0, min_len=6, max_len=40, semi_specific=False,
+               remove_met=False, batch_size=1000000):
+        '''Digests the imported protein sequences, and outputs a Digest (see the digest function)'''
+        return digest(self.proteins, enzyme, missed_cleavages, min_len, max_len, semi_specific, remove_met,
+                      batch_size)
 
 
-    def trypsinize(self, min_len=6, max_len=40):
+    def trypsinize(self, min_len=6, max_len=40, processes=1):
         '''
         Trypsinizes the imported protein sequences.
-        Hence, it makes the string in self.proteins to a list of strings, with peptides fulfilling the length criteria
+        Hence, it makes the string in self.proteins to a list of strings, with peptides fulfilling the length criteria.
+        If processes > 1, chunks of the proteins are digested in a pool of processes
         '''
         self.peptide_to_protein_dict = defaultdict(list)
         self.peptide_to_gene_dict = defaultdict(list)
-        for protein in self.proteins:
-            gene = self.protein_to_gene_dict[protein]
-            sequence = self.proteins[protein]
-            peptide_list = []
-            peptide = ''
-            for i, aa in enumerate(sequence):
-                # Get next amino acid
-                try:
-                    next_aa = sequence[i+1]
-                except IndexError:  # Last aa
-                    next_aa = ''
-                # Update peptide
-                peptide = ''.join([peptide, aa])
-                # Cleavage?
-                if aa in 'RK' and next_aa != 'P':
-                    if min_len <= len(peptide) <= max_len:
-                        peptide_list.append(peptide)
-                        self.peptide_to_protein_dict[peptide].append(protein)
-                        self.peptide_to_gene_dict[peptide].append(gene)
-                    peptide = ''
-            # Last peptide in protein
-            if min_len <= len(peptide) <= max_len:
-                peptide_list.append(peptide)
-                self.peptide_to_protein_dict[peptide].append(protein)
-                self.peptide_to_gene_dict[peptide].append(gene)
-            # Replace the sequence string with a list of all valid tryptic peptides
-            self.proteins[protein] = peptide_list
-        # Uniqify the lists of unique peptide mappings
-        for peptide in self.peptide_to_protein_dict:
-            self.peptide_to_protein_dict[peptide] = list(set(self.peptide_to_protein_dict[peptide]))
-            self.peptide_to_gene_dict[peptide] = list(set(self.peptide_to_gene_dict[peptide]))
+        if processes > 1:
+            proteins = list(self.proteins)
+            chunk_size = len(proteins) // (processes * 4) + 1
+            chunks = [(dict((protein, self.proteins[protein]) for protein in proteins[first:first + chunk_size]),
+                       min_len, max_len) for first in range(0, len(proteins), chunk_size)]
+            pool = multiprocessing.Pool(processes)
+            results = pool.map(trypsinize_chunk, chunks)
+            pool.close()
+            pool.join()
+        else:
+            results = [trypsinize_chunk((self.proteins, min_len, max_len))]
+        # Millions of small lists are built below, they hold no cycles, so the garbage collector is paused
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            self.merge_tryptic_chunks(results)
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+
+    def merge_tryptic_chunks(self, results):
+        '''Store the peptide lists and peptide maps from the outputs of trypsinize_chunk'''
+        # Merge the chunks, the peptides are ordered by protein
+        proteins = []
+        peptides = [np.array([], dtype='S1')]
+        protein_indices = [np.zeros(0, dtype=np.int64)]
+        for chunk_proteins, chunk_peptides, chunk_indices in results:
+            protein_indices.append(chunk_indices + len(proteins))
+            proteins.extend(chunk_proteins)
+            peptides.append(chunk_peptides)
+        peptides = np.concatenate(peptides)
+        protein_indices = np.concatenate(protein_indices)
+        # Replace the sequence strings with lists of all valid tryptic peptides
+        peptide_list = peptides.tolist()
+        bounds = np.searchsorted(protein_indices, np.arange(len(proteins) + 1)).tolist()
+        for protein, peptides_of_protein in zip(proteins, split_list(peptide_list, bounds)):
+            self.proteins[protein] = peptides_of_protein
+        # Map the unique peptides to their unique proteins and genes
+        unique_peptides, peptide_codes = np.unique(peptides, return_inverse=True)
+        unique_peptides = unique_peptides.tolist()
+        genes, gene_indices = np.unique(np.array([self.protein_to_gene_dict[protein] for protein in proteins]
+                                                 + ['N/A']), return_inverse=True)
+        for mapping, names, indices in ((self.peptide_to_protein_dict, proteins, protein_indices),
+                                        (self.peptide_to_gene_dict, genes.tolist(), gene_indices[protein_indices])):
+            offsets, values = group_pairs(peptide_codes, indices, len(names))
+            mapping.update(zip(unique_peptides, split_list([names[i] for i in values.tolist()], offsets.tolist())))
+
+
+
+def peptide_array(digest, chunk_size=1000000):
+    '''Output the peptides of a Digest as a fixed width string array, without making a string per peptide'''
+    lengths = digest.end - digest.start
+    width = max(int(lengths.max()) if len(lengths) else 1, 1)
+    residues = np.frombuffer(digest.buffer + '\0', dtype=np.uint8)
+    characters = np.zeros((len(lengths), width), dtype=np.uint8)
+    for first in range(0, len(lengths), chunk_size):
+        positions = digest.start[first:first + chunk_size, np.newaxis] + np.arange(width)
+        chunk = residues[np.minimum(positions, len(residues) - 1)]
+        chunk[positions >= digest.end[first:first + chunk_size, np.newaxis]] = 0  # Padding, dropped from strings
+        characters[first:first + chunk_size] = chunk
+    return characters.view('S%d' % width).ravel()
+
+
+class PeptideIndex(Mapping):
+    '''
+    Read-only dictionary from peptide to list of proteins of a digested fasta file, stored as sorted arrays.
+    peptides is a sorted array of unique peptides, the proteins of peptides[i] are
+    proteins[indices[offsets[i]:offsets[i+1]]], and the gene of proteins[j] is genes[protein_genes[j]].
+    Saved indices are loaded memory mapped, so lookups only read the pages they need.
+    '''
+
+    version = 1  # Increase when the stored arrays change
+    arrays = ('peptides', 'proteins', 'genes', 'protein_genes', 'offsets', 'indices')
+
+    def __init__(self, peptides, proteins, genes, protein_genes, offsets, indices):
+        self.peptides = peptides
+        self.proteins = proteins
+        self.genes = genes
+        self.protein_genes = protein_genes
+        self.offsets = offsets
+        self.indices = indices
+
+    @classmethod
+    def from_digest(cls, digest, protein_to_gene_dict):
+        '''Build the index from a Digest, and a dict from protein to gene'''
+        peptides, peptide_codes = np.unique(peptide_array(digest), return_inverse=True)
+        num_proteins = max(len(digest.proteins), 1)
+        pairs = np.unique(peptide_codes.astype(np.int64) * num_proteins + digest.protein)
+        pair_peptides, pair_proteins = pairs // num_proteins, pairs % num_proteins
+        counts = np.bincount(pair_peptides, minlength=len(peptides))
+        offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        # N/A is appended, so that the gene array is a string array even without proteins
+        genes, protein_genes = np.unique(np.array([protein_to_gene_dict[protein] for protein in digest.proteins]
+                                                  + ['N/A']), return_inverse=True)
+        proteins = np.array(digest.proteins) if digest.proteins else np.array([], dtype='S1')
+        return cls(peptides, proteins, genes, protein_genes[:-1].astype(np.int32), offsets,
+                   pair_proteins.astype(np.int32))
+
+    @classmethod
+    def load(cls, path):
+        '''Load an index saved in the directory path, with memory mapped arrays'''
+        return cls(*[np.load(os.path.join(path, '%s.npy' % (name)), mmap_mode='r') for name in cls.arrays])
+
+    def save(self, path, description=None):
+        '''
+        Save the index as one .npy file per array in the directory path, which is replaced as a whole, and the
+        description (e.g. the digestion parameters), if any, in a text file
+        '''
+        temporary_path = '%s.%d.tmp' % (path, os.getpid())
+        os.makedirs(temporary_path)
+        for name in self.arrays:
+            np.save(os.path.join(temporary_path, '%s.npy' % (name)), getattr(self, name))
+        if description is not None:
+            with open(os.path.join(temporary_path, 'description'), 'w') as description_file:
+                description_file.write('%s\n' % (description))
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.rename(temporary_path, path)  # Never leave a half written index
+
+    def index(self, peptide):
+        '''Output the integer id of a peptide, or None if it is not in the index'''
+        i = int(np.searchsorted(self.peptides, peptide))
+        if i < len(self.peptides) and self.peptides[i] == peptide:
+            return i
+        return None
+
+    def protein_indices(self, peptide_index):
+        '''Output the array of protein ids of a peptide id'''
+        return self.indices[self.offsets[peptide_index]:self.offsets[peptide_index + 1]]
+
+    def get_genes(self, peptide):
+        '''Output the list of unique genes of a peptide, like Fasta.peptide_to_gene_dict'''
+        i = self.index(peptide)
+        if i is None:
+            raise KeyError(peptide)
+        return self.genes[np.unique(self.protein_genes[self.protein_indices(i)])].tolist()
+
+    def __getitem__(self, peptide):
+        i = self.index(peptide)
+        if i is None:
+            raise KeyError(peptide)
+        return self.proteins[self.protein_indices(i)].tolist()
+
+    def __contains__(self, peptide):
+        return self.index(peptide) is not None
+
+    def __iter__(self):
+        return iter(self.peptides.tolist())
+
+    def __len__(self):
+        return len(self.peptides)
+
+
+def fasta_hash(pathname, index_dir):
+    '''
+    Output the sha1 of the content of a fasta file. The hash is remembered in index_dir, with the size and
+    modification time of the file, so an unchanged file is only hashed once.
+    '''
+    stat = os.stat(pathname)
+    stamp = '%d\t%r' % (stat.st_size, stat.st_mtime)
+    hash_path = os.path.join(index_dir, 'fasta.sha1')
+    try:
+        with open(hash_path) as hash_file:
+            stored_stamp, stored_hash = hash_file.read().rsplit('\t', 1)
+        if stored_stamp == stamp:
+            return stored_hash
+    except (IOError, ValueError):
+        pass
+    content_hash = hashlib.sha1()
+    with open(pathname, 'rb') as fasta_file:
+        for block in iter(lambda: fasta_file.read(1 << 20), ''):
+            content_hash.update(block)
+    content_hash = content_hash.hexdigest()
+    try:
+        with open(hash_path, 'w') as hash_file:
+            hash_file.write('%s\t%s' % (stamp, content_hash))
+    except IOError:
+        pass
+    return content_hash
+
+
+def load_peptide_index(pathname, enzyme='trypsin', missed_cleavages=0, min_len=6, max_len=40, semi_specific=False,
+                       remove_met=False, unique_proteins=False, ensembl=False, index_dir=None):
+    '''
+    Output the PeptideIndex of a fasta file digested with the given parameters (see digest and Fasta). Indices are
+    stored in index_dir (default <pathname>.peptide_index), in a directory named by the sha1 of the fasta content
+    and the parameters, so the first call digests the file and later calls open the stored index.
+    '''
+    if not isinstance(enzyme, Enzyme):
+        enzyme = ENZYMES[enzyme.lower()]
+    index_dir = index_dir or '%s.peptide_index' % (pathname)
+    if not os.path.isdir(index_dir):
+        try:
+            os.makedirs(index_dir)
+        except OSError:
+            pass
+    key = repr((fasta_hash(pathname, index_dir), tuple(enzyme), missed_cleavages, min_len, max_len,
+                bool(semi_specific), bool(remove_met), bool(unique_proteins), bool(ensembl), PeptideIndex.version))
+    path = os.path.join(index_dir, hashlib.sha1(key).hexdigest())
+    if os.path.isdir(path):
+        return PeptideIndex.load(path)
+    fasta = Fasta(pathname, unique_proteins, ensembl, indexed=compression(pathname) != 'gzip')
+    peptide_index = PeptideIndex.from_digest(fasta.digest(enzyme, missed_cleavages, min_len, max_len, semi_specific,
+                                                          remove_met), fasta.protein_to_gene_dict)
+    try:
+        peptide_index.save(path, key)
+    except (IOError, OSError) as error:
+        sys.stderr.write('Could not write peptide index %s: %s\n' % (path, error))
+    return peptide_index
+
+
+
+class PeptideMapper():
+    '''
+    Maps sets of peptides (of any specificity) to all their occurrences in a dict from protein to sequence (e.g.
+    Fasta.proteins). The sequences are concatenated, and the positions are sorted by their next prefix_length
+    residues (a truncated suffix array), so all peptides are looked up together by binary search. With
+    il_equivalent, I and L are treated as the same residue.
+    '''
+
+    def __init__(self, sequences, il_equivalent=True, prefix_length=12):
+        self.proteins = list(sequences)
+        lengths = np.array([len(sequences[protein]) for protein in self.proteins], dtype=np.int64)
+        self.starts = np.cumsum(lengths + 1) - (lengths + 1)
+        self.prefix_length = prefix_length
+        # Residue codes of 5 bits, letters (of any case) are 1 to 26, other characters 27 and separators 0
+        self.table = np.zeros(256, dtype=np.uint8)
+        self.table[:] = 27
+        self.table[ord('\n')] = 0
+        for i, aa in enumerate('ABCDEFGHIJKLMNOPQRSTUVWXYZ'):
+            self.table[ord(aa)] = self.table[ord(aa.lower())] = i + 1
+        if il_equivalent:
+            self.table[ord('I')] = self.table[ord('i')] = self.table[ord('L')]
+        buffer = '\n'.join([sequences[protein] for protein in self.proteins])
+        self.codes = self.encode(buffer)
+        # Codes of the prefix_length residues from each position, where the first residue is the most significant
+        padded = np.concatenate((self.codes, np.zeros(prefix_length, dtype=np.uint8)))
+        prefixes = np.zeros(len(self.codes), dtype=np.uint64)
+        for i in range(prefix_length):
+            prefixes <<= np.uint64(5)
+            prefixes |= padded[i:i + len(self.codes)]
+        position_type = np.int32 if len(self.codes) < 2 ** 31 else np.int64
+        self.order = np.argsort(prefixes).astype(position_type)
+        self.sorted_prefixes = prefixes[self.order]
+
+    def encode(self, sequence):
+        '''Output the array of residue codes of a string'''
+        if not sequence:
+            return np.zeros(0, dtype=np.uint8)
+        return self.table[np.frombuffer(sequence, dtype=np.uint8)]
+
+    def map(self, peptides, chunk_size=1000000):
+        '''
+        Find all occurrences of a list of peptides, and output PeptideMatches, ordered by peptide, protein and
+        position
+        '''
+        peptides = list(peptides)
+        lengths = np.array([len(peptide) for peptide in peptides], dtype=np.int64)
+        width = max(int(lengths.max()) if len(lengths) else 0, self.prefix_length)
+        # Residue codes of the peptides, padded with zeros
+        peptide_codes = np.zeros((len(peptides), width), dtype=np.uint8)
+        peptide_offsets = np.cumsum(lengths) - lengths
+        all_codes = self.encode(''.join(peptides))
+        rows = np.repeat(np.arange(len(peptides)), lengths)
+        peptide_codes[rows, np.arange(len(all_codes)) - peptide_offsets[rows]] = all_codes
+        # The range of sorted prefixes that start with each peptide
+        first = np.zeros(len(peptides), dtype=np.uint64)
+        for i in range(self.prefix_length):
+            first <<= np.uint64(5)
+            first |= peptide_codes[:, i]
+        shift = (5 * np.maximum(self.prefix_length - lengths, 0)).astype(np.uint64)
+        last = ((first >> shift) + np.uint64(1)) << shift
+        left = np.searchsorted(self.sorted_prefixes, first, side='left')
+        right = np.searchsorted(self.sorted_prefixes, last, side='left')
+        counts = np.where(lengths > 0, right - left, 0)
+        candidate_peptides = np.repeat(np.arange(len(peptides)), counts)
+        candidates = self.order[np.repeat(left, counts) + np.arange(counts.sum())
+                                - np.repeat(np.cumsum(counts) - counts, counts)].astype(np.int64)
+        # Check the residues after the prefix of longer peptides
+        if width > self.prefix_length:
+            padded = np.concatenate((self.codes, np.zeros(width, dtype=np.uint8)))
+            tail = np.arange(self.prefix_length, width)
+            keep = np.ones(len(candidates), dtype=bool)
+            long_peptides = np.flatnonzero(lengths[candidate_peptides] > self.prefix_length)
+            for first_candidate in range(0, len(long_peptides), chunk_size):
+                chunk = long_peptides[first_candidate:first_candidate + chunk_size]
+                expected = peptide_codes[candidate_peptides[chunk]][:, tail]
+                found = padded[candidates[chunk, np.newaxis] + tail]
+                inside = tail < lengths[candidate_peptides[chunk], np.newaxis]
+                keep[chunk] = ((expected == found) | ~inside).all(axis=1)
+            candidate_peptides, candidates = candidate_peptides[keep], candidates[keep]
+        proteins = np.searchsorted(self.starts, candidates, side='right') - 1
+        positions = candidates - self.starts[proteins] if len(self.starts) else candidates
+        order = np.lexsort((positions, proteins, candidate_peptides))
+        return PeptideMatches(peptides, self.proteins, candidate_peptides[order], proteins[order], positions[order])
+
+    def map_proteins(self, peptides):
+        '''Output a dict from each of the peptides to the sorted list of the unique proteins it occurs in'''
+        matches = self.map(peptides)
+        peptide_to_proteins = dict((peptide, set()) for peptide in matches.peptides)
+        for peptide_index, protein_index in zip(matches.peptide.tolist(), matches.protein.tolist()):
+            peptide_to_proteins[matches.peptides[peptide_index]].add(self.proteins[protein_index])
+        return dict((peptide, sorted(proteins)) for peptide, proteins in peptide_to_proteins.items())
+
+
+
+def peptide_pattern(enzyme):
+    '''
+    Output a regular expression that finds the fully specific peptides of an Enzyme, without missed cleavages, as
+    groups of the N-terminal cleavage residue, the other residues and the C-terminal cleavage residue
+    '''
+    cleave = '[%s]' % (re.escape(enzyme.cleave))
+    restrict = '[%s]' % (re.escape(enzyme.restrict)) if enzyme.restrict else None
+    if enzyme.side == 'C':
+        return '()(.*?)(%s%s|$)' % (cleave, '(?!%s)' % (restrict) if restrict else '')
+    return '(%s?)(.*?)()(?=%s%s|$)' % (cleave, '(?<!%s)' % (restrict) if restrict else '', cleave)
+
+
+def decoy_sequence(sequence, method='reverse', enzyme='trypsin', rng=None):
+    '''
+    Output the decoy of a protein sequence. The methods are 'reverse', 'pseudo-reverse', where each peptide of the
+    enzyme (a name in ENZYMES or an Enzyme) is reversed but keeps its cleavage residue in place, and 'shuffle',
+    where the peptides are shuffled the same way, with the random.Random rng (or the random module)
+    '''
+    if method == 'reverse':
+        return sequence[::-1]
+    if method not in ('pseudo-reverse', 'shuffle'):
+        raise ValueError('method should be reverse, pseudo-reverse or shuffle, not %s' % (method))
+    if not isinstance(enzyme, Enzyme):
+        enzyme = ENZYMES[enzyme.lower()]
+    peptides = re.findall(peptide_pattern(enzyme), sequence)
+    if method == 'pseudo-reverse':
+        return ''.join([first + moved[::-1] + last for first, moved, last in peptides])
+    pieces = []
+    for first, moved, last in peptides:
+        moved = list(moved)
+        (rng or random).shuffle(moved)
+        pieces.extend((first, ''.join(moved), last))
+    return ''.join(pieces)
+
+
+class IndexedFastaWriter():
+    '''
+    Writes fasta records with lines of line_width residues, and keeps the FaiEntry of each record. The records go to
+    a temporary path, which is renamed to pathname on close, or removed on discard.
+    '''
+
+    def __init__(self, pathname, line_width=60):
+        self.pathname = pathname
+        self.temporary_path = '%s.%d.tmp' % (pathname, os.getpid())
+        self.outfile = open(self.temporary_path, 'wb')
+        self.line_width = line_width
+        self.offset = 0
+        self.entries = []
+
+    def write(self, header, sequence):
+        '''Write a header line (with >) and a sequence'''
+        lines = [header + '\n'] + [sequence[i:i + self.line_width] + '\n'
+                                   for i in range(0, len(sequence), self.line_width)]
+        bases = min(len(sequence), self.line_width)
+        self.entries.append(FaiEntry(header.split()[0][1:], len(sequence), self.offset + len(lines[0]), bases,
+                                     bases + 1 if bases else 0))
+        data = ''.join(lines)
+        self.outfile.write(data)
+        self.offset += len(data)
+
+    def close(self):
+        '''Close the file, rename it to pathname, and write its index as <pathname>.fai'''
+        self.outfile.close()
+        os.rename(self.temporary_path, self.pathname)
+        write_index(self.entries, '%s.fai' % (self.pathname))
+
+    def discard(self):
+        '''Close and remove the temporary file, without writing pathname'''
+        self.outfile.close()
+        os.remove(self.temporary_path)
+
+
+def write_decoy_database(pathname, decoy_path=None, concatenated_path=None, method='reverse', prefix='decoy_',
+                         seed=1, enzyme='trypsin', line_width=60):
+    '''
+    Read a (plain, gzipped or BGZF) fasta file record by record, and write the decoy of each protein (see
+    decoy_sequence) to decoy_path, with prefix before the protein name, and/or each protein followed by its decoy to
+    concatenated_path. A faidx-style index of each written file is stored as <path>.fai in the same pass. Shuffled
+    decoys are reproducible with the same seed. Outputs the number of proteins. The files are written to temporary
+    paths and renamed when done, so a failure leaves no partial files.
+    '''
+    if decoy_path is None and concatenated_path is None:
+        raise ValueError('give decoy_path, concatenated_path or both')
+    rng = random.Random(seed)
+    infile = open_fasta(pathname)
+    writers = []
+    finished = False
+    try:
+        for path in (decoy_path, concatenated_path):
+            if path is not None:
+                writers.append(IndexedFastaWriter(path, line_width))
+        num_proteins = 0
+        for header, sequence in parse_entries(infile):
+            decoy = ('>%s%s' % (prefix, header[1:]), decoy_sequence(sequence, method, enzyme, rng))
+            if concatenated_path is not None:
+                writers[-1].write(header, sequence)
+                writers[-1].write(*decoy)
+            if decoy_path is not None:
+                writers[0].write(*decoy)
+            num_proteins += 1
+        finished = True
+    finally:
+        infile.close()
+        # Only complete files are renamed to their paths, a failure leaves no partial files
+        for writer in writers:
+            if finished:
+                writer.close()
+            else:
+                writer.discard()
+    return num_proteins
 
 
 
@@ -7,60 +7,452 @@
 # Version: 20140318.1
 
 from lxml import etree
-from pygraph.classes.graph import graph
-from pygraph.algorithms.accessibility import connected_components
-from itertools import combinations, chain
+from itertools import chain
+import argparse
+import hashlib
+import heapq
+import json
+import multiprocessing
+import os
 import sys
+import time
+
+STATE_VERSION = 2  # version of the files written by save_state
 
 # Outputs the identified proteins identified using parsimony. If a pair of 
 # equally sized sets of proteins both cover all peptides in their group, the 
-# set that matched first is returned.
+# set that the cover search finds first is returned. The cover search is an 
+# exact branch-and-bound, after removing dominated proteins and selecting 
+# mandatory ones.
 #
 # This program assumes that the input percolator results XML validates.
 #
+# Indistinguishable proteins, that have the same peptides, are reported as a 
+# protein group, with the protein names separated by commas.
+#
 # Tab-delimited output format: 
-# <protein name>\t<peptide 1>\t...\t<peptide N>
+# <protein name(s)>\t<peptide 1>\t...\t<peptide N>
 
-def parse_percolator_xml(filename, q_value_cutoff=0.01):
+def parse_percolator_xml(filenames, q_value_cutoff=0.01, ns_num=14):
     """
-    parse_percolator_xml - takes a file name and q value cutoff and returns 
-        a dictionary keyed on identified peptides (give the specified cutoff) 
-        with a list of potential protein matches as values.
+    parse_percolator_xml - takes a file name (or a list of file names) and q 
+        value cutoff and returns a dictionary keyed on identified peptides 
+        (give the specified cutoff) with a list of potential protein matches 
+        as values. The files are streamed, so only the peptides below the 
+        cutoff are kept in memory. A peptide found in several files gets the 
+        proteins of all of them.
     """
-    NS = '{http://per-colator.com/percolator_out/14}'
-    with open(filename, 'r') as f:
-        perc_output = etree.parse(f).getroot()
+    if isinstance(filenames, basestring):
+        filenames = [filenames]
+    NS = '{{http://per-colator.com/percolator_out/{}}}'.format(ns_num)
+    peptide_tag = '{}peptide'.format(NS)
+    peptide_id = '{}peptide_id'.format(NS)
+    q_value_tag = '{}q_value'.format(NS)
+    protein_id_tag = '{}protein_id'.format(NS)
+    # listen to psms and proteins too, so that they are cleared as well
+    tags = ['{}psm'.format(NS), peptide_tag, '{}protein'.format(NS)]
     peptides = {}
-    for pep in perc_output.iter('{}peptide'.format(NS)):
-        pep_seq = pep.attrib.get('{}peptide_id'.format(NS))
-        q_value_str = pep.find('{}q_value'.format(NS)).text
-        try:
-            q_value = float(q_value_str)
-        except ValueError:
-            raise ValueError("Invalid q value {}".format(q_value_str))
-        if pep_seq in peptides:
-            raise RuntimeError("Duplicate peptide in percolator xml output")
-        if q_value > q_value_cutoff:
-            continue
-        protein_ids = [p.text for p in pep.iter('{}protein_id'.format(NS))]
-        peptides[pep_seq] = protein_ids
+    for filename in filenames:
+        file_peptides = set()
+        for event, pep in etree.iterparse(filename, events=('end',), tag=tags):
+            if pep.tag == peptide_tag:
+                pep_seq = pep.attrib.get(peptide_id)
+                q_value_str = None
+                protein_ids = []
+                for child in pep:
+                    if child.tag == q_value_tag:
+                        q_value_str = child.text
+                    elif child.tag == protein_id_tag:
+                        protein_ids.append(child.text)
+                try:
+                    q_value = float(q_value_str)
+                except (TypeError, ValueError):
+                    raise ValueError("Invalid q value {}".format(q_value_str))
+                if pep_seq in file_peptides:
+                    raise RuntimeError("Duplicate peptide in percolator xml "
+                        "output")
+                if q_value <= q_value_cutoff:
+                    file_peptides.add(pep_seq)
+                    if pep_seq in peptides:
+                        peptides[pep_seq].extend(p for p in protein_ids 
+                            if p not in peptides[pep_seq])
+                    else:
+                        peptides[pep_seq] = protein_ids
+            # free the element, and the (already cleared) ones before it
+            pep.clear()
+            while pep.getprevious() is not None:
+                del pep.getparent()[0]
     return peptides
 
-def parsimonous_protein_identification(peptides):
+def find_protein_clusters(peptides):
     """
-    parsimonous_protein_identification - takes a dict of the form
-        {<peptide_seq>: <protein_name>, [<protein_na,e> ...] } and returns the 
-        proteins identified using parsimony.
+    find_protein_clusters - takes a dict of peptide to list of proteins and 
+        returns a list of sets of proteins connected by shared peptides. Uses 
+        union-find on the peptide-protein pairs, so the cost grows with the 
+        number of pairs rather than with the square of the proteins per 
+        peptide.
+    """
+    parent = {}
+
+    def find(protein):
+        root = protein
+        while parent[root] != root:
+            root = parent[root]
+        # compress the path to the root
+        while parent[protein] != root:
+            parent[protein], protein = root, parent[protein]
+        return root
+
+    for proteins in peptides.values():
+        if not proteins:
+            continue
+        for protein in proteins:
+            if protein not in parent:
+                parent[protein] = protein
+        root = find(proteins[0])
+        for protein in proteins[1:]:
+            other = find(protein)
+            if other != root:
+                parent[other] = root
+    clusters = {}
+    for protein in parent:
+        clusters.setdefault(find(protein), set()).add(protein)
+    return clusters.values()
+
+def group_indistinguishable_proteins(protein2peptides, proteins, distinct=()):
+    """
+    group_indistinguishable_proteins - takes a dict of protein to peptides, 
+        the proteins of a cluster and the proteins that must not be grouped, 
+        and returns a dict of the first protein (by name) of each group of 
+        proteins with exactly the same peptides, to the sorted group members.
+    """
+    groups = {}
+    for protein in sorted(proteins):
+        if protein in distinct:
+            key = protein
+        else:
+            key = frozenset(protein2peptides[protein])
+        groups.setdefault(key, []).append(protein)
+    return dict((members[0], members) for members in groups.values())
+
+def popcount(mask):
+    """
+    popcount - takes an integer bit mask and returns its number of set bits.
+    """
+    return bin(mask).count('1')
+
+def bit_indices(mask):
+    """
+    bit_indices - takes an integer bit mask and returns the indices of its set 
+        bits.
+    """
+    indices = []
+    while mask:
+        bit = mask & -mask
+        indices.append(bit.bit_length() - 1)
+        mask ^= bit
+    return indices
+
+def greedy_cover(candidates, uncovered, deadline=None):
+    """
+    greedy_cover - takes a dict of protein to set of peptides, a set of 
+        uncovered peptides and an optional deadline (time.time() value), and 
+        returns a list of proteins covering them, each time picking the 
+        protein (first by name) that covers most uncovered peptides. The 
+        uncovered counts are kept up to date through the proteins of each 
+        peptide, in a lazy heap. When the deadline passes, the remaining 
+        peptides are covered one at a time, by their protein that covers 
+        most of them.
+    """
+    peptides_of = {}
+    proteins_of = {}
+    counts = {}
+    for p, peptides in candidates.items():
+        peptides_of[p] = [peptide for peptide in peptides 
+            if peptide in uncovered]
+        counts[p] = len(peptides_of[p])
+        for peptide in peptides_of[p]:
+            proteins_of.setdefault(peptide, []).append(p)
+    heap = [(-count, p) for p, count in counts.items() if count]
+    heapq.heapify(heap)
+    remaining = set(proteins_of)
+    cover = []
+
+    def choose(p):
+        cover.append(p)
+        for peptide in peptides_of[p]:
+            if peptide in remaining:
+                remaining.remove(peptide)
+                for q in proteins_of[peptide]:
+                    counts[q] -= 1
+
+    while remaining:
+        if deadline is not None and time.time() > deadline:
+            for peptide in sorted(remaining):
+                if peptide in remaining:
+                    choose(min(proteins_of[peptide], 
+                        key=lambda q: (-counts[q], q)))
+            break
+        count, p = heapq.heappop(heap)
+        if -count != counts[p]:
+            # outdated entry, the protein covers fewer peptides by now
+            if counts[p]:
+                heapq.heappush(heap, (-counts[p], p))
+            continue
+        choose(p)
+    return cover
+
+def reduce_cover_problem(candidates, uncovered, deadline=None):
+    """
+    reduce_cover_problem - takes a dict of protein to set of peptides, a set 
+        of uncovered peptides and an optional deadline (time.time() value), 
+        and repeatedly removes dominated proteins (whose uncovered peptides 
+        are all covered by another protein) and selects mandatory proteins 
+        (the only remaining protein of some peptide). Returns the mandatory 
+        proteins, the remaining candidates (restricted to the uncovered 
+        peptides) and the still uncovered peptides. When the deadline passes, 
+        the reduction stops where it is.
+    """
+    mandatory = []
+    uncovered = set(uncovered)
+    changed = True
+    while changed:
+        changed = False
+        candidates = dict((p, peptides & uncovered) 
+            for p, peptides in candidates.items() 
+            if not peptides.isdisjoint(uncovered))
+        # largest first, so that a protein can only be dominated by kept ones, 
+        # which all cover any one of its peptides
+        ordered = sorted(candidates, key=lambda p: (-len(candidates[p]), p))
+        kept = []
+        kept_with = {}  # peptide to the kept proteins covering it
+        for i, p in enumerate(ordered):
+            if deadline is not None and time.time() > deadline:
+                kept.extend(ordered[i:])
+                return mandatory, dict((q, candidates[q]) for q in kept), \
+                    uncovered
+            peptides = candidates[p]
+            if any(peptides <= candidates[q] 
+                    for q in kept_with.get(min(peptides), ())):
+                changed = True
+            else:
+                kept.append(p)
+                for peptide in peptides:
+                    kept_with.setdefault(peptide, []).append(p)
+        candidates = dict((p, candidates[p]) for p in kept)
+        # peptides covered by exactly one candidate
+        counts = {}
+        for peptides in candidates.values():
+            for peptide in peptides:
+                counts[peptide] = counts.get(peptide, 0) + 1
+        for p in kept:
+            if any(counts[peptide] == 1 for peptide in candidates[p]):
+                mandatory.append(p)
+                uncovered -= candidates[p]
+                changed = True
+    return mandatory, candidates, uncovered
+
+def split_components(candidates):
+    """
+    split_components - takes a dict of protein to set of peptides and 
+        returns a list of dicts, one for each group of proteins connected 
+        by shared peptides.
+    """
+    proteins_of = {}
+    for p, peptides in candidates.items():
+        for peptide in peptides:
+            proteins_of.setdefault(peptide, []).append(p)
+    components = find_protein_clusters(proteins_of)
+    # proteins without peptides are not connected to anything
+    components.extend(set([p]) for p, peptides in candidates.items() 
+        if not peptides)
+    return [dict((p, candidates[p]) for p in sorted(component)) 
+        for component in components]
+
+def branch_and_bound(candidates, deadline=None):
+    """
+    branch_and_bound - takes a dict of protein to set of peptides and an 
+        optional deadline (time.time() value), and returns a tuple of a 
+        minimum list of proteins covering the peptides, and whether the 
+        search finished before the deadline. The greedy cover is used as the 
+        first upper bound, and is returned if nothing better was found in 
+        time. The search works on peptide bit masks.
+    """
+    uncovered = set(chain(*candidates.values()))
+    best = [greedy_cover(candidates, uncovered, deadline)]
+    finished = [True]
+
+    def search(chosen, uncovered, candidates):
+        if deadline is not None and time.time() > deadline:
+            finished[0] = False
+            return
+        if not uncovered:
+            if len(chosen) < len(best[0]):
+                best[0] = list(chosen)
+            return
+        # lower bound: every further protein covers at most max_size peptides
+        max_size = max(popcount(m) for m in candidates.values())
+        needed = (popcount(uncovered) + max_size - 1) // max_size
+        if len(chosen) + needed >= len(best[0]):
+            return
+        # branch on the proteins of the (first) peptide with fewest proteins
+        counts = {}
+        for m in candidates.values():
+            for peptide in bit_indices(m & uncovered):
+                counts[peptide] = counts.get(peptide, 0) + 1
+        peptide = min(counts, key=lambda peptide: (counts[peptide], peptide))
+        branch_proteins = [p for p, m in candidates.items() 
+            if m >> peptide & 1]
+        branch_proteins.sort(key=lambda p: (-popcount(candidates[p]), p))
+        for p in branch_proteins:
+            remaining = uncovered & ~candidates[p]
+            chosen.append(p)
+            search(chosen, remaining, dict((q, m & remaining) 
+                for q, m in candidates.items() if m & remaining))
+            chosen.pop()
+            if not finished[0]:
+                return
+
+    if deadline is not None and time.time() > deadline:
+        return best[0], False
+    masks, all_peptides = peptide_masks(candidates, candidates)
+    search([], all_peptides, dict((p, m) for p, m in masks.items() if m))
+    return best[0], finished[0]
+
+def peptide_masks(protein2peptides, proteins):
+    """
+    peptide_masks - takes a dict of protein to peptides and the proteins of a 
+        cluster, and returns a dict of protein to a bit mask of its peptides, 
+        and the bit mask of all peptides.
+    """
+    peptide_bits = {}
+    masks = {}
+    for p in sorted(proteins):
+        mask = 0
+        for peptide in sorted(protein2peptides[p]):
+            if peptide not in peptide_bits:
+                peptide_bits[peptide] = 1 << len(peptide_bits)
+            mask |= peptide_bits[peptide]
+        masks[p] = mask
+    return masks, (1 << len(peptide_bits)) - 1
+
+def find_minimum_cover(protein2peptides, proteins, time_budget=None, 
+        selected=()):
+    """
+    find_minimum_cover - takes a dict of protein to peptides, the proteins of 
+        a cluster, an optional time budget in seconds and the proteins that 
+        are already selected (such as those with unique peptides), and returns 
+        a tuple of a minimum list of proteins covering all peptides of the 
+        cluster, including the selected ones, and whether the cover is proven 
+        to be minimum. When the time budget runs out, the best cover found so 
+        far is returned.
+    """
+    deadline = None if time_budget is None else time.time() + time_budget
+    candidates = dict((p, frozenset(protein2peptides[p])) for p in proteins)
+    uncovered = set(chain(*candidates.values()))
+    for p in selected:
+        uncovered -= candidates[p]
+    cover, candidates, uncovered = reduce_cover_problem(candidates, uncovered, 
+        deadline)
+    cover.extend(selected)
+    if deadline is not None and time.time() > deadline:
+        cover.extend(greedy_cover(candidates, uncovered, deadline))
+        return sorted(cover), False
+    optimal = True
+    for component in split_components(candidates):
+        component_cover, finished = branch_and_bound(component, deadline)
+        cover.extend(component_cover)
+        optimal = optimal and finished
+    return sorted(cover), optimal
+
+def solve_cluster(arguments):
+    """
+    solve_cluster - takes a tuple of a cluster id, a dict of protein to 
+        peptides for the proteins of the cluster, the proteins that must not 
+        be grouped and a time budget, and returns a tuple of the cluster id, 
+        the protein groups, the chosen representatives of the groups, the 
+        status ('optimal', 'timeout' or 'greedy') and the seconds spent.
+    """
+    cluster_id, protein2peptides, distinct, time_budget = arguments
+    start = time.time()
+    groups = group_indistinguishable_proteins(protein2peptides, 
+        protein2peptides, distinct)
+    # proteins with unique peptides are identified anyway, so their shared 
+    # peptides are already covered
+    selected = sorted(p for p in groups if p in distinct)
+    try:
+        covering, optimal = find_minimum_cover(protein2peptides, groups, 
+            time_budget, selected)
+        status = "optimal" if optimal else "timeout"
+    except (RuntimeError, MemoryError):
+        # the exact search went too deep, fall back to the greedy cover
+        candidates = dict((p, set(protein2peptides[p])) for p in groups)
+        uncovered = set(chain(*candidates.values()))
+        for p in selected:
+            uncovered -= candidates[p]
+        covering = sorted(selected + greedy_cover(candidates, uncovered))
+        status = "greedy"
+    return cluster_id, groups, covering, status, time.time() - start
+
+def cluster_key(protein2peptides, distinct):
+    """
+    cluster_key - takes a dict of protein to peptides for the proteins of a 
+        cluster and the proteins that must not be grouped, and returns a hex 
+        digest that only changes when the cover problem of the cluster does.
+    """
+    items = sorted((p, sorted(set(peptides)), p in distinct) 
+        for p, peptides in protein2peptides.items())
+    return hashlib.sha1(repr(items)).hexdigest()
+
+def load_state(filename):
+    """
+    load_state - takes a file name and returns the parsimony state stored in 
+        it, or an empty state if the file does not exist.
+    """
+    if not os.path.exists(filename):
+        return {"version": STATE_VERSION, "unique": {}, "clusters": {}}
+    with open(filename) as f:
+        state = json.load(f)
+    if state.get("version") != STATE_VERSION:
+        raise ValueError("Unknown parsimony state version in {}".format(
+            filename))
+    return state
+
+def save_state(filename, state):
+    """save_state - takes a file name and a parsimony state, and stores it."""
+    temporary_filename = "{}.tmp".format(filename)
+    with open(temporary_filename, "w") as f:
+        json.dump(state, f)
+    os.rename(temporary_filename, filename)
+
+def state_proteins(state):
+    """
+    state_proteins - takes a parsimony state and returns the identified 
+        proteins, as parsimonous_protein_identification does.
+    """
+    detected_proteins = dict(state["unique"])
+    for cluster in state["clusters"].values():
+        detected_proteins.update(cluster["detected"])
+    return detected_proteins
+
+def prepare_clusters(peptides):
+    """
+    prepare_clusters - takes a dict of peptide to list of proteins and returns 
+        a tuple of a dict of the proteins of unique peptides to that peptide 
+        (in a list), a dict of protein to its shared peptides and the list of 
+        clusters of proteins connected by shared peptides, largest first. The 
+        input dict is not changed.
     """
     detected_proteins = {}
     protein2peptides = {}
+    shared_peptides = {}
 
     # start with the uniquely determined proteins
     for peptide, proteins in peptides.items():
         if len(proteins) == 1:
             detected_proteins[proteins[0]] = [peptide]
-            peptides.pop(peptide)
         else:
+            shared_peptides[peptide] = proteins
             for p in proteins:
                 if not p in protein2peptides:
                     protein2peptides[p] = [peptide]
@@ -68,49 +460,115 @@ def parsimonous_protein_identification(peptides):
                     protein2peptides[p].append(peptide)
 
     # remaining peptides have multiple potential proteins, use parsimony
-    g = graph()
+    clusters = find_protein_clusters(shared_peptides)
+    clusters.sort(key=lambda cluster: (-len(cluster), min(cluster)))
+    return detected_proteins, protein2peptides, clusters
 
-    # identify protein clusters
-    for peptide, proteins in peptides.items():
-        for protein in proteins:
-            if not g.has_node(protein):
-                g.add_node(protein)
-        for p1, p2 in combinations(proteins, 2):
-            if not g.has_edge((p1, p2)):
-                g.add_edge((p1, p2))
-    connected = connected_components(g).items()
-    clusters = {subgraph: set() for protein, subgraph in connected}
-    for protein, subgraph in connected:
-        clusters[subgraph] = clusters[subgraph].union(set((protein,)))
-
-    def find_covering(proteins):
-        peptides = set(chain(*(tuple(protein2peptides[p]) for p in proteins)))
-        for k in range(1, len(proteins) + 1):
-            for covering in combinations(proteins, k):
-                covered = set(chain(*(tuple(protein2peptides[p]) for p in 
-                    covering)))
-                if len(covered) == len(peptides):
-                    return covering
-        return None
-
-    # find the minimal protein covering of each cluster
-    for cluster in clusters.values():
-        covering = find_covering(cluster)
-        if covering is None:
-            print "Error, failed to cover " + str(subgraph)
-            sys.exit(1)
+def parsimonous_protein_identification(peptides, time_budget=None, 
+        processes=1, report=None, state=None):
+    """
+    parsimonous_protein_identification - takes a dict of the form
+        {<peptide_seq>: <protein_name>, [<protein_na,e> ...] } and returns the 
+        proteins identified using parsimony. Indistinguishable proteins are 
+        reported as one comma-separated protein group. The clusters are solved 
+        in a pool of processes, largest first, and time_budget limits the 
+        seconds spent on the cover search of each cluster. If report is an 
+        open file, a tab-delimited line with the id, number of proteins, 
+        number of groups, cover size, status and seconds of each cluster is 
+        written to it. If state is given (see load_state), the optimal covers 
+        of clusters that did not change since the state was stored are 
+        reused, and the state is updated with the clusters of this run.
+    """
+    detected_proteins, protein2peptides, clusters = prepare_clusters(peptides)
+
+    # find the minimal protein covering of each cluster, where proteins with 
+    # the same peptides are collapsed into one group (proteins with unique 
+    # peptides are distinguishable, and never grouped)
+    unique_proteins = dict(detected_proteins)
+    previous_clusters = state["clusters"] if state is not None else {}
+    stored_clusters = {}
+    keys = []
+    tasks = []
+    reused = []
+    for i, cluster in enumerate(clusters):
+        cluster_protein2peptides = dict((p, protein2peptides[p]) 
+            for p in cluster)
+        distinct = set(p for p in cluster if p in detected_proteins)
+        keys.append(cluster_key(cluster_protein2peptides, distinct))
+        previous = previous_clusters.get(keys[i])
+        if previous is not None and previous["status"] == "optimal":
+            reused.append((i, previous["groups"], previous["covering"], 
+                "reused", 0.0))
         else:
-            for protein in covering:
-                detected_proteins[protein] = protein2peptides[protein]
+            tasks.append((i, cluster_protein2peptides, distinct, time_budget))
+    pool = None
+    if processes == 1 or not tasks:
+        results = (solve_cluster(task) for task in tasks)
+    else:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap_unordered(solve_cluster, tasks, chunksize=1)
+    try:
+        for cluster_id, groups, covering, status, seconds in chain(reused, 
+                results):
+            if status not in ("optimal", "reused"):
+                sys.stderr.write("Warning, {} cover of cluster {} with {} "
+                    "proteins may not be minimal\n".format(status, cluster_id, 
+                    len(clusters[cluster_id])))
+            if report is not None:
+                report.write("{}\t{}\t{}\t{}\t{}\t{:.3f}\n".format(
+                    cluster_id, len(clusters[cluster_id]), len(groups), 
+                    len(covering), status, seconds))
+            detected = dict((",".join(groups[protein]), 
+                unique_proteins.get(protein, []) + protein2peptides[protein]) 
+                for protein in covering)
+            detected_proteins.update(detected)
+            stored_clusters[keys[cluster_id]] = {"groups": groups, 
+                "covering": covering, "detected": detected, 
+                "status": "optimal" if status == "reused" else status}
+    finally:
+        # all results are in (or an error stopped the loop), so stop the 
+        # workers rather than wait for them
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    if state is not None:
+        state["unique"] = unique_proteins
+        state["clusters"] = stored_clusters
 
     return detected_proteins
 
 if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        print "Usage: parsimony.py <name of percolator xml output file>"
-        sys.exit(1)
-    per_xml_filename = sys.argv[1]
-    peptides = parse_percolator_xml(per_xml_filename)
-    proteins = parsimonous_protein_identification(peptides)
+    parser = argparse.ArgumentParser(description="Outputs the parsimonous "
+        "set of proteins from percolator xml output.")
+    parser.add_argument("pout", nargs="*", 
+        help="percolator xml output file(s), read as one input")
+    parser.add_argument("-q", "--q-value-cutoff", type=float, default=0.01, 
+        help="q value cutoff of the peptides")
+    parser.add_argument("-p", "--processes", type=int, default=1, 
+        help="number of processes solving clusters in parallel")
+    parser.add_argument("-t", "--time-budget", type=float, default=60.0, 
+        help="seconds of cover search per cluster, after which the best cover "
+        "found so far is used, 0 for no limit (default 60)")
+    parser.add_argument("-r", "--report", default=None, 
+        help="file for the status and timing of each cluster")
+    parser.add_argument("-s", "--state", default=None, 
+        help="file with the clusters and covers of the previous run, only "
+        "changed clusters are solved again, and the file is updated (without "
+        "pout files, the output is regenerated from it)")
+    args = parser.parse_args()
+    if not args.pout and not args.state:
+        parser.error("give pout files, a state file, or both")
+    state = load_state(args.state) if args.state else None
+    if args.pout:
+        peptides = parse_percolator_xml(args.pout, args.q_value_cutoff)
+        report = open(args.report, "w") if args.report else None
+        proteins = parsimonous_protein_identification(peptides, 
+            args.time_budget or None, args.processes, report, state)
+        if report is not None:
+            report.close()
+        if state is not None:
+            save_state(args.state, state)
+    else:
+        proteins = state_proteins(state)
     for protein, peptides in proteins.items():
         print "{}\t{}".format(protein, "\t".join(peptides))
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+
+# parsimony_benchmark.py - times parsimony.py on synthetic percolator xml
+#                          output with tunable peptide-protein graphs
+#
+# Every case generates a pout file with clusters of proteins connected by
+# shared peptides, and then, in a fresh process, times the parsing, the
+# clustering and the covering, and records the peak memory after each of them.
+# With several processes, the cover memory is the peak of the pool workers if
+# that is larger.
+#
+# Tab-delimited output format, one line per case:
+# <proteins>\t<cluster size>\t<distribution>\t<degree>\t<shared>\t<peptides>\t
+# <clusters>\t<inexact clusters>\t<parse s>\t<cluster s>\t<cover s>\t
+# <parse MB>\t<cluster MB>\t<cover MB>
+
+from itertools import product
+import argparse
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import parsimony
+
+AMINO_ACIDS = "ACDEFGHILMNPQRSTVWY"  # no K, it only ends the peptides
+
+def cluster_sizes(n_proteins, max_size, distribution, alpha, rng):
+    """
+    cluster_sizes - takes the number of proteins, the largest cluster size,
+        the name of the size distribution ("fixed", "uniform" or "powerlaw",
+        where P(k) is proportional to k^-alpha) and a random.Random, and
+        yields cluster sizes adding up to the number of proteins.
+    """
+    max_size = max(1, min(max_size, n_proteins))
+    if distribution == "powerlaw":
+        weights = [k ** -alpha for k in range(1, max_size + 1)]
+        cumulative = []
+        total = 0.0
+        for weight in weights:
+            total += weight
+            cumulative.append(total / sum(weights))
+    remaining = n_proteins
+    while remaining > 0:
+        if distribution == "fixed":
+            size = max_size
+        elif distribution == "uniform":
+            size = rng.randint(1, max_size)
+        else:
+            u = rng.random()
+            size = next((k + 1 for k, c in enumerate(cumulative) if u <= c),
+                max_size)
+        size = min(size, remaining)
+        remaining -= size
+        yield size
+
+def peptide_sequence(number, rng):
+    """
+    peptide_sequence - takes a peptide number and a random.Random and returns
+        a tryptic looking peptide, unique for the number.
+    """
+    letters = [rng.choice(AMINO_ACIDS) for i in range(6)]
+    while True:
+        number, digit = divmod(number, len(AMINO_ACIDS))
+        letters.append(AMINO_ACIDS[digit])
+        if number == 0:
+            break
+    return "".join(letters) + "K"
+
+def generate_clusters(n_proteins, max_size, distribution="powerlaw",
+        alpha=2.0, peptides_per_protein=5, degree=3, shared=0.5, seed=1):
+    """
+    generate_clusters - yields, cluster by cluster, lists of (peptide,
+        proteins) pairs. Each protein has on average peptides_per_protein
+        peptides, and a peptide is shared with probability shared, by 2 to
+        degree proteins of its cluster. The proteins of a cluster are chained
+        by shared peptides, so that the whole cluster is connected.
+    """
+    rng = random.Random(seed)
+    n_protein = 0
+    n_peptide = 0
+    for size in cluster_sizes(n_proteins, max_size, distribution, alpha, rng):
+        proteins = ["BENCH_{}".format(n_protein + i) for i in range(size)]
+        n_protein += size
+        matches = []
+        for i in range(1, size):
+            members = set([proteins[i], proteins[rng.randrange(i)]])
+            for j in range(rng.randint(2, max(2, degree)) - 2):
+                members.add(rng.choice(proteins))
+            matches.append(sorted(members))
+        for i in range(size * peptides_per_protein - len(matches)):
+            if size > 1 and rng.random() < shared:
+                matches.append(sorted(rng.sample(proteins,
+                    min(size, rng.randint(2, max(2, degree))))))
+            else:
+                matches.append([rng.choice(proteins)])
+        cluster = []
+        for members in matches:
+            cluster.append((peptide_sequence(n_peptide, rng), members))
+            n_peptide += 1
+        yield cluster
+
+def write_pout(filename, clusters, q_value_cutoff=0.01, noise=0.1,
+        psms_per_peptide=1, ns_num=14, seed=1):
+    """
+    write_pout - takes a file name and the clusters of generate_clusters, and
+        writes them as percolator xml output, where the peptides of the
+        clusters get q values below q_value_cutoff. A fraction noise (at most
+        one) of extra peptides, above the cutoff, and psms_per_peptide psms
+        per peptide are written as well, for realistic file sizes. Returns the
+        number of peptides below the cutoff.
+    """
+    rng = random.Random(seed)
+    NS = "http://per-colator.com/percolator_out/{}".format(ns_num)
+    psm_line = ('<psm p:psm_id="psm_{0}" p:decoy="false"><svm_score>{1:.4f}'
+        '</svm_score><q_value>{2:.6f}</q_value><pep>{2:.6f}</pep><exp_mass>'
+        '1000.0</exp_mass><calc_mass>1000.0</calc_mass><peptide_seq n="K" '
+        'c="A" seq="{3}"/>{4}<p_value>{2:.6f}</p_value></psm>\n')
+    peptide_line = ('<peptide p:peptide_id="{0}" p:decoy="false"><svm_score>'
+        '{1:.4f}</svm_score><q_value>{2:.6f}</q_value><pep>{2:.6f}</pep>'
+        '<exp_mass>1000.0</exp_mass><calc_mass>1000.0</calc_mass>{3}<p_value>'
+        '{2:.6f}</p_value><psm_ids>{4}</psm_ids></peptide>\n')
+    n_kept = 0
+    n_psm = 0
+    out = open(filename, "w")
+    peptides_out = tempfile.TemporaryFile()
+    out.write('<?xml version="1.0" encoding="UTF-8"?>\n<percolator_output '
+        'xmlns="{0}" xmlns:p="{0}" p:majorVersion="2" p:minorVersion="04">\n'
+        '<process_info><command_line>parsimony_benchmark.py</command_line>'
+        '</process_info>\n<psms>\n'.format(NS))
+    for cluster in clusters:
+        peptides = [(peptide, proteins, rng.random() * q_value_cutoff)
+            for peptide, proteins in cluster]
+        n_kept += len(peptides)
+        n_noise = min(len(cluster), int(round(len(cluster) * noise)))
+        for peptide, proteins in rng.sample(cluster, n_noise):
+            q_value = 0.5 + rng.random() / 2
+            peptides.append((peptide[::-1], proteins,
+                q_value_cutoff + (1.0 - q_value_cutoff) * q_value))
+        for peptide, proteins, q_value in peptides:
+            protein_ids = "".join("<protein_id>{}</protein_id>".format(p)
+                for p in proteins)
+            psm_ids = []
+            for i in range(psms_per_peptide):
+                out.write(psm_line.format(n_psm, rng.gauss(0, 1), q_value,
+                    peptide, protein_ids))
+                psm_ids.append("<psm_id>psm_{}</psm_id>".format(n_psm))
+                n_psm += 1
+            peptides_out.write(peptide_line.format(peptide, rng.gauss(0, 1),
+                q_value, protein_ids, "".join(psm_ids)))
+    out.write('</psms>\n<peptides>\n')
+    peptides_out.seek(0)
+    shutil.copyfileobj(peptides_out, out)
+    peptides_out.close()
+    out.write('</peptides>\n</percolator_output>\n')
+    out.close()
+    return n_kept
+
+def peak_memory(who=resource.RUSAGE_SELF):
+    """
+    peak_memory - returns the peak resident memory of the process, or with
+        resource.RUSAGE_CHILDREN of its largest finished child process, in MB.
+    """
+    peak = resource.getrusage(who).ru_maxrss
+    # kilobytes on linux, bytes on mac
+    return peak / (1024.0 * 1024.0 if sys.platform == "darwin" else 1024.0)
+
+def run_case(filename, q_value_cutoff, time_budget, processes, results):
+    """
+    run_case - parses the pout file, clusters the proteins with 
+        prepare_clusters and runs parsimonous_protein_identification on the 
+        peptides, and puts the number of peptides, clusters and clusters 
+        without a proven minimal cover, the seconds of each step and the peak 
+        memory after each step on the results queue. The cover time is that 
+        of parsimonous_protein_identification less the clustering time. Runs 
+        in its own process, so that the peak memory is of this case only.
+    """
+    start = time.time()
+    peptides = parsimony.parse_percolator_xml(filename, q_value_cutoff)
+    parse_time = time.time() - start
+    parse_memory = peak_memory()
+    start = time.time()
+    parsimony.prepare_clusters(peptides)
+    cluster_time = time.time() - start
+    cluster_memory = peak_memory()
+    n_peptides = len(peptides)
+    report = tempfile.TemporaryFile()
+    start = time.time()
+    parsimony.parsimonous_protein_identification(peptides, time_budget,
+        processes, report)
+    cover_time = max(0.0, time.time() - start - cluster_time)
+    cover_memory = max(peak_memory(), peak_memory(resource.RUSAGE_CHILDREN))
+    report.seek(0)
+    statuses = [line.split("\t")[4] for line in report]
+    report.close()
+    n_inexact = sum(1 for status in statuses if status != "optimal")
+    results.put((n_peptides, len(statuses), n_inexact, parse_time,
+        cluster_time, cover_time, parse_memory, cluster_memory, cover_memory))
+
+def benchmark(n_proteins, max_size, distribution, degree, shared, args):
+    """
+    benchmark - generates the pout file of one case, runs it args.repeats
+        times in fresh processes, and returns the fastest times and the
+        largest peak memories.
+    """
+    filename = os.path.join(args.directory, "bench_{}_{}_{}_{}_{}.pout.xml"
+        .format(n_proteins, max_size, distribution, degree, shared))
+    clusters = generate_clusters(n_proteins, max_size, distribution,
+        args.alpha, args.peptides_per_protein, degree, shared, args.seed)
+    n_kept = write_pout(filename, clusters, args.q_value_cutoff, args.noise,
+        args.psms_per_peptide, seed=args.seed)
+    runs = []
+    for i in range(args.repeats):
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(target=run_case, args=(filename,
+            args.q_value_cutoff, args.time_budget, args.processes, results))
+        process.start()
+        runs.append(results.get())
+        process.join()
+        if runs[-1][0] != n_kept:
+            raise RuntimeError("Parsed {} peptides below the cutoff, expected "
+                "{}".format(runs[-1][0], n_kept))
+    if not args.keep:
+        os.remove(filename)
+    return runs[0][:3] + tuple(min(run[i] for run in runs)
+        for i in range(3, 6)) + tuple(max(run[i] for run in runs)
+        for i in range(6, 9))
+
+def int_list(value):
+    return [int(v) for v in value.split(",")]
+
+def float_list(value):
+    return [float(v) for v in value.split(",")]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Times parsimony.py on "
+        "synthetic percolator xml output. The options taking comma-separated "
+        "lists are combined into all cases.")
+    parser.add_argument("-n", "--proteins", type=int_list, default=[10000],
+        help="number of proteins")
+    parser.add_argument("-c", "--cluster-size", type=int_list, default=[20],
+        help="largest number of proteins in a cluster")
+    parser.add_argument("-d", "--distribution", default=["powerlaw"],
+        type=lambda value: value.split(","),
+        help="distribution of the cluster sizes: fixed, uniform or powerlaw")
+    parser.add_argument("-g", "--degree", type=int_list, default=[3],
+        help="largest number of proteins of a shared peptide")
+    parser.add_argument("-s", "--shared", type=float_list, default=[0.5],
+        help="fraction of the peptides that are shared")
+    parser.add_argument("-a", "--alpha", type=float, default=2.0,
+        help="exponent of the powerlaw distribution")
+    parser.add_argument("-m", "--peptides-per-protein", type=int, default=5,
+        help="average number of peptides per protein")
+    parser.add_argument("--psms-per-peptide", type=int, default=1,
+        help="number of psms written per peptide")
+    parser.add_argument("--noise", type=float, default=0.1,
+        help="extra peptides above the q value cutoff, per peptide below it")
+    parser.add_argument("-q", "--q-value-cutoff", type=float, default=0.01,
+        help="q value cutoff of the peptides")
+    parser.add_argument("-t", "--time-budget", type=float, default=None,
+        help="seconds of exact cover search per cluster")
+    parser.add_argument("-p", "--processes", type=int, default=1,
+        help="number of processes solving clusters in parallel")
+    parser.add_argument("-r", "--repeats", type=int, default=3,
+        help="number of runs of each case, the fastest is reported")
+    parser.add_argument("--seed", type=int, default=1,
+        help="seed of the random graphs")
+    parser.add_argument("--directory", default=None,
+        help="directory for the generated pout files (default: a temporary "
+        "directory)")
+    parser.add_argument("--keep", action="store_true",
+        help="keep the generated pout files")
+    args = parser.parse_args()
+    for distribution in args.distribution:
+        if distribution not in ("fixed", "uniform", "powerlaw"):
+            parser.error("unknown distribution {}".format(distribution))
+    temporary = args.directory is None
+    if temporary:
+        args.directory = tempfile.mkdtemp(prefix="parsimony_benchmark")
+    print "\t".join(["proteins", "cluster_size", "distribution", "degree",
+        "shared", "peptides", "clusters", "inexact", "parse_s", "cluster_s",
+        "cover_s", "parse_mb", "cluster_mb", "cover_mb"])
+    for case in product(args.proteins, args.cluster_size, args.distribution,
+            args.degree, args.shared):
+        result = benchmark(*(case + (args,)))
+        print "\t".join([str(value) for value in case + result[:3]] +
+            ["{:.3f}".format(value) for value in result[3:6]] +
+            ["{:.1f}".format(value) for value in result[6:]])
+        sys.stdout.flush()
+    if temporary and not args.keep:
+        shutil.rmtree(args.directory)
@@ -0,0 +1,362 @@
+#! /usr/bin/env python
+
+'''
+Module for parsing Percolator's tab-delimited pin and pout files, with the same getters as percolator_xml.
+If percolator_tab.py is in the python path, example usage:
+
+>> from percolator_tab import PinTab, PoutTab
+>> pin = PinTab('path/to/pin.tab')
+>> target_feature_value = pin.get_feature_values(2, isDecoy=False)  # Gets third feature
+>> pout = PoutTab(psms='path/to/target.psms', decoy_psms='path/to/decoy.psms')
+>> target_qvalues = pout.get_qvalues('psm')
+
+Pipelines can be moved off xml with the converters:
+
+>> from percolator_tab import pin_xml_to_tab
+>> pin_xml_to_tab('path/to/pin.xml', 'path/to/pin.tab')
+'''
+
+import os
+import re
+from itertools import islice
+import numpy as np
+from lxml import etree
+from percolator_xml import Pin, Pout, PinArrays, PoutArrays, BackgroundWriter, namespace_declarations, tostring_in_root
+
+
+def strip_flanks(peptide):
+    '''Take a peptide with flanking amino acids, e.g. K.PEPTIDE.R, and output the peptide without them'''
+    if len(peptide) > 4 and peptide[1] == '.' and peptide[-2] == '.':
+        return peptide[2:-2]
+    return peptide
+
+
+def read_header(infile):
+    '''Read the header line of an open tab-delimited file, and output the column names'''
+    return infile.readline().rstrip('\r\n').split('\t')
+
+
+def iter_chunks(infile, chunk_size=100000):
+    '''Yield lists of at most chunk_size rows (lists of strings), skipping empty and DefaultDirection lines'''
+    while True:
+        lines = list(islice(infile, chunk_size))
+        if not lines:
+            return
+        yield [line.rstrip('\r\n').split('\t') for line in lines
+               if line.strip() and not line.startswith('DefaultDirection')]
+
+
+def find_charge_columns(header, columns):
+    '''Output (column, charge) tuples of the one-hot Charge<N> features among the given columns'''
+    matches = [(i, re.match(r'Charge(\d+)$', header[i])) for i in columns]
+    return [(i, match.group(1)) for i, match in matches if match]
+
+
+def to_floats(rows, columns):
+    '''Convert the given columns of a chunk of rows into a 2-D float64 array, in one numpy call'''
+    strings = np.array([[row[i] for i in columns] for row in rows], dtype=str)
+    return strings.reshape(len(rows), len(columns)).astype(np.float64)
+
+
+class PinTab(Pin):
+    '''Class that reads a tab-delimited pin file, with the same getters as Pin (but without an xml tree to change)'''
+
+    # Columns that are psm attributes rather than features, and their names in pin xml
+    attribute_columns = {'ExpMass': 'experimentalMass', 'CalcMass': 'calculatedMass'}
+
+    def __init__(self, pathname, chunk_size=100000):
+        '''Initialize with pathname to tab-delimited pin-file'''
+        self.pathname = pathname
+        self.chunk_size = chunk_size
+        self.tree = None
+        self.arrays = None
+
+    def parse_tree(self):
+        '''Tab-delimited files have no xml tree'''
+        self.no_tree('reading xml elements')
+
+    def no_tree(self, operation):
+        '''Raise a TypeError for an operation that needs the xml tree'''
+        raise TypeError('%s needs an xml tree, but %s is a tab-delimited pin file, convert it with pin_tab_to_xml' %
+                        (operation, self.pathname))
+
+    def remove_features(self, *args, **kwargs):
+        '''Tab-delimited pin files can not be changed'''
+        self.no_tree('remove_features')
+
+    def add_features(self, *args, **kwargs):
+        '''Tab-delimited pin files can not be changed'''
+        self.no_tree('add_features')
+
+    def add_feature(self, *args, **kwargs):
+        '''Tab-delimited pin files can not be changed'''
+        self.no_tree('add_feature')
+
+    def write(self, outpath):
+        '''Tab-delimited pin files can not be written as xml here'''
+        self.no_tree('write')
+
+    def to_arrays(self):
+        '''Read all psms in chunks, and output a PinArrays, see Pin.to_arrays'''
+        if self.arrays is not None:
+            return self.arrays
+        infile = open(self.pathname)
+        header = read_header(infile)
+        scan_column = header.index('ScanNr')
+        peptide_column = header.index('Peptide')
+        feature_columns = [i for i in range(scan_column + 1, peptide_column) if header[i] not in self.attribute_columns]
+        attribute_columns = dict((self.attribute_columns[header[i]], i) for i in range(scan_column + 1, peptide_column)
+                                 if header[i] in self.attribute_columns)
+        attribute_columns['scanNumber'] = scan_column
+        charge_columns = find_charge_columns(header, feature_columns)
+        ids, labels, sequences, protein_ids, matrices = [], [], [], [], []
+        attributes = dict((name, []) for name in attribute_columns)
+        protein_offsets = [0]
+        for rows in iter_chunks(infile, self.chunk_size):
+            ids.extend([row[0] for row in rows])
+            labels.extend([row[1] for row in rows])
+            matrices.append(to_floats(rows, feature_columns))
+            for name, column in attribute_columns.items():
+                attributes[name].extend([row[column] for row in rows])
+            for row in rows:
+                sequences.append(strip_flanks(row[peptide_column]))
+                protein_ids.extend(row[peptide_column + 1:])
+                protein_offsets.append(len(protein_ids))
+        infile.close()
+        decoys = np.array(labels) == '-1'
+        matrix = np.vstack(matrices) if matrices else np.zeros((0, len(feature_columns)))
+        # Same attribute names and values as in pin xml
+        attributes = dict((name, np.array(values, dtype=object)) for name, values in attributes.items())
+        attributes['id'] = np.array(ids, dtype=object)
+        attributes['isDecoy'] = np.where(decoys, 'true', 'false').astype(object)
+        # The chargeState is the first one-hot Charge<N> feature, as in pin_tab_to_xml
+        charge_names = np.array(['0'] + [charge for i, charge in charge_columns], dtype=object)
+        is_charge = np.hstack([np.zeros((len(ids), 1), dtype=bool)] +
+                              [matrix[:, [feature_columns.index(i)]] == 1 for i, charge in charge_columns])
+        attributes['chargeState'] = charge_names[np.where(is_charge.any(axis=1), is_charge.argmax(axis=1), 0)]
+        self.arrays = PinArrays([header[i] for i in feature_columns], matrix, np.array(ids, dtype=object),
+                                decoys, np.array(sequences, dtype=object), np.array(protein_offsets, dtype=np.int64),
+                                np.array(protein_ids, dtype=object), attributes)
+        return self.arrays
+
+
+class PoutTab(Pout):
+    '''
+    Class that reads the tab-delimited output files of Percolator, with the same getters as Pout.
+    Takes the pathnames of the target and decoy files of each level (as given to percolator -m, -r, -l, -M, -B, -L).
+    '''
+
+    # Column names of the ids of each level, and of the values in a PoutRecord (the masses are not in the files)
+    id_columns = {'psm': 'PSMId', 'peptide': 'peptide', 'protein': 'ProteinId'}
+    value_columns = {'svm_score': 'score', 'q_value': 'q-value', 'pep': 'posterior_error_prob', 'p_value': 'p-value'}
+
+    def __init__(self, psms=None, peptides=None, proteins=None, decoy_psms=None, decoy_peptides=None,
+                 decoy_proteins=None, chunk_size=100000):
+        '''Initialize with pathnames to the tab-delimited files, levels without files can not be read'''
+        self.paths = {('psm', False): psms, ('peptide', False): peptides, ('protein', False): proteins,
+                      ('psm', True): decoy_psms, ('peptide', True): decoy_peptides, ('protein', True): decoy_proteins}
+        self.chunk_size = chunk_size
+        self.streaming = False
+        self.tree = None
+        self.arrays = {}
+        self.parsed_mods = {}
+
+    def parse_tree(self):
+        '''Tab-delimited files have no xml tree'''
+        raise TypeError('Reading xml elements (e.g. child elements other than %s) needs a pout xml file, '
+                        'tab-delimited pout files only have the parsed arrays' % (', '.join(self.record_values)))
+
+    def to_arrays(self, level):
+        '''Read the target and decoy files of a level in chunks, and output a PoutArrays, see Pout.to_arrays'''
+        if level in self.arrays:
+            return self.arrays[level]
+        ids, decoys, protein_ids = [], [], []
+        values = dict((name, []) for name in self.record_values)
+        protein_offsets = [0]
+        pathnames = [(self.paths[(level, isDecoy)], isDecoy) for isDecoy in (False, True) if self.paths[(level, isDecoy)]]
+        if not pathnames:
+            raise ValueError('No tab-delimited %s file was given' % (level))
+        for pathname, isDecoy in pathnames:
+            infile = open(pathname)
+            header = read_header(infile)
+            id_column = header.index(self.id_columns[level])
+            # The proteins of psms and peptides are in the last columns
+            protein_column = header.index('proteinIds') if level != 'protein' else len(header)
+            for rows in iter_chunks(infile, self.chunk_size):
+                ids.extend([row[id_column] for row in rows])
+                decoys.extend([isDecoy] * len(rows))
+                for name in self.record_values:
+                    if self.value_columns.get(name) in header:
+                        values[name].append(to_floats(rows, [header.index(self.value_columns[name])])[:, 0])
+                    else:
+                        values[name].append(np.repeat(np.nan, len(rows)))
+                for row in rows:
+                    protein_ids.extend(row[protein_column:])
+                    protein_offsets.append(len(protein_ids))
+            infile.close()
+        if level == 'peptide':
+            ids = [strip_flanks(peptide) for peptide in ids]
+        columns = [np.concatenate(values[name]) if values[name] else np.zeros(0) for name in self.record_values]
+        arrays = PoutArrays(*([np.array(ids, dtype=object), np.array(decoys, dtype=bool), np.ones(len(ids), dtype=bool)] +
+                              columns + [np.array(protein_offsets, dtype=np.int64), np.array(protein_ids, dtype=object)]))
+        self.arrays[level] = arrays
+        return arrays
+
+
+def pin_xml_to_tab(inpath, outpath, ns_num=13, is_huge_tree=False, masses=True):
+    '''
+    Convert a pin xml file to a tab-delimited pin file, in one streaming pass.
+    If masses is True, the ExpMass and CalcMass columns are written (understood by Percolator 3 and later).
+    '''
+    ns = 'http://per-colator.com/percolator_in/%s' % (ns_num)
+    descriptions_tag = '{%s}featureDescriptions' % (ns)
+    scan_tag = '{%s}fragSpectrumScan' % (ns)
+    features_tag = '{%s}features' % (ns)
+    peptide_tag = '{%s}peptide' % (ns)
+    occurence_tag = '{%s}occurence' % (ns)
+    outfile = BackgroundWriter(open(outpath, 'w'))
+    try:
+        for event, element in etree.iterparse(inpath, events=('end',), tag=[descriptions_tag, scan_tag],
+                                              huge_tree=is_huge_tree):
+            if element.tag == descriptions_tag:
+                header = ['SpecId', 'Label', 'ScanNr']
+                if masses:
+                    header.extend(['ExpMass', 'CalcMass'])
+                header.extend([description.attrib['name'] for description in element])
+                header.extend(['Peptide', 'Proteins'])
+                outfile.write('%s\n' % ('\t'.join(header)))
+                continue
+            lines = []
+            for psm in element:
+                row = [psm.attrib['id'], '-1' if psm.attrib['isDecoy'] == 'true' else '1', element.attrib['scanNumber']]
+                if masses:
+                    row.extend([psm.attrib['experimentalMass'], psm.attrib['calculatedMass']])
+                occurences = psm.findall(occurence_tag)
+                sequence = psm.find(peptide_tag)[0].text
+                flanks = (occurences[0].get('flankN', '-'), occurences[0].get('flankC', '-')) if occurences else ('-', '-')
+                row.extend([feature.text for feature in psm.find(features_tag)])
+                row.append('%s.%s.%s' % (flanks[0], sequence, flanks[1]))
+                row.extend([occurence.attrib['proteinId'] for occurence in occurences])
+                lines.append('\t'.join(row))
+            if lines:
+                outfile.write('%s\n' % ('\n'.join(lines)))
+            # Free the scan, and the (already cleared) scans before it
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+    finally:
+        outfile.close()
+
+
+def pin_tab_to_xml(inpath, outpath, ns_num=13, chunk_size=100000):
+    '''
+    Convert a tab-delimited pin file to pin xml, in one streaming pass. Consecutive psms with the same ScanNr
+    share a fragSpectrumScan. The chargeState is taken from one-hot Charge<N> features, and is 0 without them.
+    The file is written to a temporary path and renamed when done, so a failing conversion leaves no partial file.
+    '''
+    ns = 'http://per-colator.com/percolator_in/%s' % (ns_num)
+    infile = open(inpath)
+    header = read_header(infile)
+    scan_column = header.index('ScanNr')
+    peptide_column = header.index('Peptide')
+    feature_columns = [i for i in range(scan_column + 1, peptide_column) if header[i] not in PinTab.attribute_columns]
+    mass_columns = dict((PinTab.attribute_columns[header[i]], i) for i in range(scan_column + 1, peptide_column)
+                        if header[i] in PinTab.attribute_columns)
+    charge_columns = find_charge_columns(header, feature_columns)
+    # The children are serialized without the namespace declaration of the root
+    nsmap = {None: ns}
+    declarations = namespace_declarations(nsmap)
+    shell = etree.Element('{%s}percolator_input' % (ns), nsmap=nsmap,
+                          majorVersion=str(ns_num // 10), minorVersion=str(ns_num % 10))
+    shell.text = '\n'
+    root_start, root_end = etree.tostring(shell, encoding='UTF-8', xml_declaration=False).split('\n')
+    temporary_path = '%s.%d.tmp' % (outpath, os.getpid())
+    writer = BackgroundWriter(open(temporary_path, 'wb'))
+    finished = False
+    try:
+        writer.write("<?xml version='1.0' encoding='UTF-8'?>\n%s\n" % (root_start))
+        descriptions = etree.Element('{%s}featureDescriptions' % (ns), nsmap=nsmap)
+        for i in feature_columns:
+            etree.SubElement(descriptions, '{%s}featureDescription' % (ns)).set('name', header[i])
+        writer.write('%s\n' % (tostring_in_root(descriptions, declarations)))
+        scan = None
+        for rows in iter_chunks(infile, chunk_size):
+            for row in rows:
+                # Start a new scan element when the scan number changes
+                if scan is None or scan.attrib['scanNumber'] != row[scan_column]:
+                    if scan is not None:
+                        writer.write('%s\n' % (tostring_in_root(scan, declarations)))
+                    scan = etree.Element('{%s}fragSpectrumScan' % (ns), nsmap=nsmap)
+                    scan.set('scanNumber', row[scan_column])
+                charges = [charge for i, charge in charge_columns if float(row[i]) == 1]
+                psm = etree.SubElement(scan, '{%s}peptideSpectrumMatch' % (ns))
+                psm.set('id', row[0])
+                psm.set('isDecoy', 'true' if row[1] == '-1' else 'false')
+                psm.set('chargeState', charges[0] if charges else '0')
+                psm.set('experimentalMass', row[mass_columns['experimentalMass']] if 'experimentalMass' in mass_columns else '0')
+                psm.set('calculatedMass', row[mass_columns['calculatedMass']] if 'calculatedMass' in mass_columns else '0')
+                features = etree.SubElement(psm, '{%s}features' % (ns))
+                for i in feature_columns:
+                    etree.SubElement(features, '{%s}feature' % (ns)).text = row[i]
+                peptide = row[peptide_column]
+                etree.SubElement(etree.SubElement(psm, '{%s}peptide' % (ns)), '{%s}peptideSequence' % (ns)).text = strip_flanks(peptide)
+                flanks = (peptide[0], peptide[-1]) if strip_flanks(peptide) != peptide else ('-', '-')
+                for protein in row[peptide_column + 1:]:
+                    occurence = etree.SubElement(psm, '{%s}occurence' % (ns))
+                    occurence.set('flankN', flanks[0])
+                    occurence.set('flankC', flanks[1])
+                    occurence.set('proteinId', protein)
+        if scan is not None:
+            writer.write('%s\n' % (tostring_in_root(scan, declarations)))
+        writer.write(root_end)
+        finished = True
+    finally:
+        try:
+            writer.close()
+        finally:
+            infile.close()
+            if not finished:
+                os.remove(temporary_path)
+    os.rename(temporary_path, outpath)
+
+def pout_xml_to_tab(inpath, outpath, level='psm', isDecoy=False, ns_num=14, is_huge_tree=False):
+    '''
+    Convert the targets (or decoys) of one level of a pout xml file to a tab-delimited file, in one streaming pass.
+    The columns are the ones of Percolator's tab-delimited output, and can be read with PoutTab.
+    '''
+    pout = Pout(inpath, ns_num=ns_num, is_huge_tree=is_huge_tree, streaming=True)
+    peptide_seq_tag = '{%s}peptide_seq' % (pout.ns)
+    psm_id_tag = '{%s}psm_ids/{%s}psm_id' % (pout.ns, pout.ns)
+    outfile = BackgroundWriter(open(outpath, 'w'))
+    try:
+        if level == 'protein':
+            outfile.write('ProteinId\tq-value\tposterior_error_prob\tpeptideIds\n')
+        else:
+            outfile.write('PSMId\tscore\tq-value\tposterior_error_prob\tpeptide\tproteinIds\n')
+        for element in pout.iter_elements(level):
+            record = pout.element_to_record(element, level)
+            if not pout.is_selected(record, isDecoy):
+                continue
+            if level == 'psm':
+                peptide_seq = element.find(peptide_seq_tag)
+                row = [record.id, repr(record.svm_score), repr(record.q_value), repr(record.pep),
+                       '%s.%s.%s' % (peptide_seq.get('n', '-'), peptide_seq.get('seq'), peptide_seq.get('c', '-'))]
+                row.extend(record.protein_ids)
+            elif level == 'peptide':
+                psm_id = element.find(psm_id_tag)
+                row = [psm_id.text if psm_id is not None else record.id, repr(record.svm_score),
+                       repr(record.q_value), repr(record.pep), record.id]
+                row.extend(record.protein_ids)
+            else:
+                row = [record.id, repr(record.q_value), repr(record.pep)]
+                row.extend([peptide_seq.get('seq') for peptide_seq in element.findall(peptide_seq_tag)])
+            outfile.write('%s\n' % ('\t'.join(row)))
+    finally:
+        outfile.close()
+
+
+def main():
+    print "This is a module with a few functions for parsing percolator tab-delimited files"
+
+if __name__ == "__main__":
+    main()
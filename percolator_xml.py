@@ -8,189 +8,576 @@ If percolator_xml.py is in the python path, example usage:
 >> pin = Pin('path/to/pin.xml')
 >> target_feature_value = pin.get_feature_values(2, isDecoy=False)  # Gets third feature
 
+Huge pout files can be read in constant memory, at the cost of reading the file once per getter:
+
+>> from percolator_xml import Pout
+>> pout = Pout('path/to/pout.xml', streaming=True)
+>> target_qvalues = pout.get_qvalues('psm')
+
+With cache=True, the parsed arrays are stored next to the file, and later loads skip the xml parsing:
+
+>> pout = Pout('path/to/pout.xml', cache=True)
+
+Huge pin files can be rewritten without holding the tree in memory:
+
+>> from percolator_xml import rewrite_pin, DropFeatures, AddFeatures
+>> rewrite_pin('in.pin.xml', 'out.pin.xml', [DropFeatures(['lnrSp']), AddFeatures('rt', {'rt': psm_id_to_rt})])
+
 /Viktor
 '''
 
+import os
+import re
 import sys
+import glob
+import multiprocessing
+import Queue
+import threading
+from collections import namedtuple, Mapping
+import numpy as np
 from lxml import etree
 
+# Lightweight record of a psm, peptide or protein element of a pout file, missing values are nan
+PoutRecord = namedtuple('PoutRecord', ['id', 'isDecoy', 'svm_score', 'q_value', 'pep', 'p_value', 'exp_mass', 'calc_mass',
+                                       'protein_ids'])
+
+# Columnar numpy arrays of all psms, peptides or proteins of a pout file, see Pout.to_arrays
+PoutArrays = namedtuple('PoutArrays', ['id', 'isDecoy', 'hasDecoy', 'svm_score', 'q_value', 'pep', 'p_value',
+                                       'exp_mass', 'calc_mass', 'protein_offsets', 'protein_ids'])
+
+# All feature names and values of a pin file, with the aligned psm arrays, see Pin.to_arrays
+PinArrays = namedtuple('PinArrays', ['feature_names', 'features', 'id', 'isDecoy', 'sequence',
+                                     'protein_offsets', 'protein_ids', 'attributes'])
+
+# A 2-D array of all feature values of a pin file, with the aligned psm arrays, see Pin.get_feature_matrix
+PinMatrix = namedtuple('PinMatrix', ['features', 'id', 'isDecoy', 'sequence'])
+
+# Compiled patterns for parse_mods
+unimod_pattern = re.compile(r'\[UNIMOD:(\d+)\]')
+strip_pattern = re.compile(r'\[UNIMOD:|[^A-Za-z]')
+
+def parse_mods(seq, memo=None):
+    '''
+    Take a peptide sequence, strip all occurences of [UNIMOD:XX] (and any other non-letters), and output the stripped
+    sequence with a tuple of (position, UNIMOD id) of the modifications. The position is the index of the modified
+    amino acid in the stripped sequence, or -1 for the N-terminus. If memo is a dictionary, the output is memoized in it.
+    '''
+    if memo is not None and seq in memo:
+        return memo[seq]
+    if seq.isalpha():
+        parsed = (seq, ())
+    else:
+        parts, mods = [], []
+        length = 0
+        start = 0
+        for match in unimod_pattern.finditer(seq):
+            part = strip_pattern.sub('', seq[start:match.start()])
+            parts.append(part)
+            length += len(part)
+            mods.append((length - 1, int(match.group(1))))
+            start = match.end()
+        parts.append(strip_pattern.sub('', seq[start:]))
+        parsed = (''.join(parts), tuple(mods))
+    if memo is not None:
+        memo[seq] = parsed
+    return parsed
+
+
+class PeptideProteinMap(Mapping):
+    '''
+    Read-only dictionary from peptide to list of proteins, stored as interned tables and a CSR mapping.
+    peptides and proteins are sorted arrays of unique strings (their indices are the integer ids), and
+    the proteins of peptides[i] are proteins[indices[offsets[i]:offsets[i+1]]].
+    '''
+
+    def __init__(self, peptides, proteins, offsets, indices):
+        self.peptides = peptides
+        self.proteins = proteins
+        self.offsets = offsets
+        self.indices = indices
+
+    @classmethod
+    def from_entries(cls, peptides, starts, ends, protein_values, merge='first'):
+        '''
+        Build the map from one peptide per entry (e.g. psm), where the proteins of entry i are
+        protein_values[starts[i]:ends[i]]. With merge='first', a repeated peptide keeps the proteins of its first entry,
+        with merge='union', it gets the unique proteins of all its entries.
+        '''
+        peptides = np.asarray(peptides, dtype=object)
+        lengths = np.asarray(ends, dtype=np.int64) - np.asarray(starts, dtype=np.int64)
+        # Positions of the proteins of all entries in protein_values, and the entry of each position
+        first_positions = np.concatenate(([0], np.cumsum(lengths)[:-1])).astype(np.int64)
+        positions = np.repeat(np.asarray(starts, dtype=np.int64) - first_positions, lengths) + np.arange(lengths.sum())
+        entries = np.repeat(np.arange(len(peptides)), lengths)
+        # Intern the peptides and proteins
+        proteins, protein_codes = np.unique(np.asarray(protein_values, dtype=object)[positions], return_inverse=True)
+        unique_peptides, first_entries, peptide_codes = np.unique(peptides, return_index=True, return_inverse=True)
+        if merge == 'first':
+            keep = first_entries[peptide_codes[entries]] == entries
+            pair_peptides = peptide_codes[entries][keep]
+            pair_proteins = protein_codes[keep]
+            order = np.argsort(pair_peptides, kind='mergesort')  # Stable, so the order of the proteins is kept
+            pair_peptides, pair_proteins = pair_peptides[order], pair_proteins[order]
+        elif merge == 'union':
+            num_proteins = max(len(proteins), 1)
+            pairs = np.unique(peptide_codes[entries].astype(np.int64) * num_proteins + protein_codes)
+            pair_peptides, pair_proteins = pairs // num_proteins, pairs % num_proteins
+        else:
+            raise ValueError('merge should be first or union, not %s' % (merge))
+        counts = np.bincount(pair_peptides, minlength=len(unique_peptides))
+        offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        return cls(unique_peptides, proteins, offsets, pair_proteins.astype(np.int32))
+
+    def index(self, peptide):
+        '''Output the integer id of a peptide, or None if it is not in the map'''
+        i = int(np.searchsorted(self.peptides, peptide))
+        if i < len(self.peptides) and self.peptides[i] == peptide:
+            return i
+        return None
+
+    def protein_indices(self, peptide_index):
+        '''Output the array of protein ids of a peptide id'''
+        return self.indices[self.offsets[peptide_index]:self.offsets[peptide_index + 1]]
+
+    def __getitem__(self, peptide):
+        i = self.index(peptide)
+        if i is None:
+            raise KeyError(peptide)
+        return self.proteins[self.protein_indices(i)].tolist()
+
+    def to_dict(self):
+        '''Output a plain dictionary of peptide to list of proteins'''
+        protein_lists = np.split(self.proteins[self.indices], self.offsets[1:-1]) if len(self.peptides) else []
+        return dict(zip(self.peptides.tolist(), [proteins.tolist() for proteins in protein_lists]))
+
+    def __iter__(self):
+        return iter(self.peptides.tolist())
+
+    def __len__(self):
+        return len(self.peptides)
+
+
+class ParseCache():
+    '''
+    Sidecar .npz file (by default pathname.npz) with the parsed arrays of a pin- or pout-file.
+    The cache is only used if the path, size, modification time and namespace version of the file are unchanged.
+    '''
+
+    version = 2  # Increase when the stored arrays change
+
+    def __init__(self, pathname, kind, ns_num, cache_path=None):
+        self.cache_path = cache_path or '%s.npz' % (pathname)
+        stat = os.stat(pathname)
+        self.key = '%s|%s|%d|%r|%s|%d' % (kind, os.path.abspath(pathname), stat.st_size, stat.st_mtime, ns_num, self.version)
+
+    def load(self):
+        '''Output a dictionary of the stored arrays, or None if there is no valid cache'''
+        try:
+            stored = np.load(self.cache_path)
+        except (IOError, ValueError):
+            return None
+        try:
+            if 'key' not in stored.files or str(stored['key']) != self.key:
+                return None
+            columns = {}
+            for name in stored.files:
+                if name != 'key':
+                    column = stored[name]
+                    # Strings are stored as fixed width arrays, but used as object arrays
+                    columns[name] = column.astype(object) if column.dtype.kind in 'SU' else column
+            return columns
+        finally:
+            stored.close()
+
+    def save(self, columns):
+        '''Store a dictionary of arrays, a cache that can not be written is only reported'''
+        storable = {}
+        for name, column in columns.items():
+            if column.dtype == object:
+                column = np.array(column.tolist()) if len(column) > 0 else np.array([], dtype='S1')
+            storable[name] = column
+        temporary_path = '%s.%d.tmp' % (self.cache_path, os.getpid())
+        try:
+            with open(temporary_path, 'wb') as outfile:
+                np.savez(outfile, key=np.array(self.key), **storable)
+            os.rename(temporary_path, self.cache_path)  # Never leave a half written cache
+        except (IOError, OSError) as error:
+            sys.stderr.write('Could not write cache %s: %s\n' % (self.cache_path, error))
+
+
+def pin_arrays_to_columns(arrays):
+    '''Convert PinArrays to a flat dictionary of arrays, for ParseCache'''
+    columns = dict((field, getattr(arrays, field)) for field in PinArrays._fields if field != 'attributes')
+    columns['feature_names'] = np.array(arrays.feature_names, dtype=object)
+    for name, values in arrays.attributes.items():
+        columns['attribute_%s' % (name)] = values
+    return columns
+
+
+def pin_arrays_from_columns(columns):
+    '''Convert a flat dictionary of arrays from ParseCache to PinArrays'''
+    attributes = dict((name[len('attribute_'):], values) for name, values in columns.items() if name.startswith('attribute_'))
+    fields = [columns[field] for field in PinArrays._fields if field != 'attributes']
+    fields[0] = fields[0].tolist()  # The feature names are a list
+    return PinArrays(*(fields + [attributes]))
+
+
 class Pout():
     '''Class that reads pout file, takes pathname as input'''
 
-    def __init__(self, pathname, ns_num=14, is_huge_tree=False):
-        '''Initialize with pathname to pout-file'''        
+    # Numerical child elements that are stored in a PoutRecord
+    record_values = ('svm_score', 'q_value', 'pep', 'p_value', 'exp_mass', 'calc_mass')
+
+    levels = ('psm', 'peptide', 'protein')
+
+    def __init__(self, pathname, ns_num=14, is_huge_tree=False, streaming=False, cache=False, cache_path=None):
+        '''Initialize with pathname to pout-file'''
+        '''If streaming is True, the tree is not stored, and every getter reads the file in constant memory'''
+        '''If cache is True, the parsed arrays are stored in (or read from) a sidecar .npz file, see ParseCache'''
         self.pathname = pathname
         self.ns = 'http://per-colator.com/percolator_out/%s' % (ns_num)
-        parser = etree.XMLParser(ns_clean=False, huge_tree=is_huge_tree)
-        self.tree = etree.parse(self.pathname, parser)
+        self.is_huge_tree = is_huge_tree
+        self.streaming = streaming
+        self.tree = None
+        self.arrays = {}  # Level to PoutArrays, filled by to_arrays
+        self.parsed_mods = {}  # Memo table of parse_mods, from modified sequence to output
+        if cache:
+            parse_cache = ParseCache(pathname, 'pout', ns_num, cache_path)
+            columns = parse_cache.load()
+            if columns is not None:
+                for level in self.levels:
+                    self.arrays[level] = PoutArrays(*[columns['%s_%s' % (level, field)] for field in PoutArrays._fields])
+            else:
+                columns = {}
+                for level in self.levels:
+                    self.arrays[level] = self.to_arrays(level)
+                    for field in PoutArrays._fields:
+                        columns['%s_%s' % (level, field)] = getattr(self.arrays[level], field)
+                parse_cache.save(columns)
+        elif not streaming:
+            self.parse_tree()
+
+    def parse_tree(self):
+        '''Parse the pout-file, unless it has been parsed already'''
+        if self.tree is None:
+            parser = etree.XMLParser(ns_clean=False, huge_tree=self.is_huge_tree)
+            self.tree = etree.parse(self.pathname, parser)
+
+    def iter_elements(self, level):
+        '''Yield the psm, peptide or protein elements, when streaming they are cleared after use'''
+        if not self.streaming:
+            self.parse_tree()
+            for element in self.tree.findall('{%(n)s}%(l)ss/{%(n)s}%(l)s' % dict(n=self.ns, l=level)):
+                yield element
+            return
+        tag = '{%s}%s' % (self.ns, level)
+        # Listen to all three levels, so that the elements of the other levels are cleared as well
+        tags = ['{%s}%s' % (self.ns, l) for l in self.levels]
+        for event, element in etree.iterparse(self.pathname, events=('end',), tag=tags, huge_tree=self.is_huge_tree):
+            if element.tag == tag:
+                yield element
+            # Free the element, and the (already cleared) siblings before it
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+    def element_to_record(self, element, level):
+        '''Convert a psm, peptide or protein element into a PoutRecord, visiting each child once'''
+        values = {}
+        protein_ids = []
+        start = len(self.ns) + 2  # Length of '{ns}'
+        for child in element:
+            name = child.tag[start:]
+            if name == 'protein_id':
+                protein_ids.append(child.text)
+            elif name in self.record_values:
+                values[name] = float(child.text)
+        decoy = element.get('{%s}decoy' % (self.ns))
+        if decoy is not None:
+            decoy = decoy == 'true'  # Convert element string boolean to boolean
+        nan = float('nan')
+        return PoutRecord(element.get('{%s}%s_id' % (self.ns, level)), decoy,
+                          *([values.get(name, nan) for name in self.record_values] + [tuple(protein_ids)]))
+
+    def child_value(self, element, name):
+        '''Output the numerical value of a child element that is not stored in a PoutRecord'''
+        return float(element.find('{%s}%s' % (self.ns, name)).text)
+
+    def iter_records(self, level):
+        '''Yield a PoutRecord for each psm, peptide or protein of the pout file'''
+        for element in self.iter_elements(level):
+            yield self.element_to_record(element, level)
+
+    def is_selected(self, record, isDecoy, require_decoy=True):
+        '''Check whether a record has the requested decoy status, without require_decoy records lacking it are kept'''
+        if record.isDecoy is None:
+            # Seems Percolator was run without the -Z flag, so there's no p:decoy attribute
+            if isDecoy == True and require_decoy:
+                sys.exit('KeyError: There might be no p:decoy attribute')
+            return True
+        return record.isDecoy == isDecoy
+
+    def to_arrays(self, level):
+        '''
+        Read all psms, peptides or proteins in one pass, and output a PoutArrays of columnar numpy arrays.
+        The proteins of entry i are protein_ids[protein_offsets[i]:protein_offsets[i+1]].
+        Unless streaming, the arrays are cached, so calling this again is free.
+        '''
+        if level in self.arrays:
+            return self.arrays[level]
+        ids, decoys, has_decoys, protein_ids = [], [], [], []
+        values = dict((name, []) for name in self.record_values)
+        protein_offsets = [0]
+        for record in self.iter_records(level):
+            ids.append(record.id)
+            decoys.append(record.isDecoy == True)
+            has_decoys.append(record.isDecoy is not None)
+            for name in self.record_values:
+                values[name].append(getattr(record, name))
+            protein_ids.extend(record.protein_ids)
+            protein_offsets.append(len(protein_ids))
+        arrays = PoutArrays(np.array(ids, dtype=object), np.array(decoys, dtype=bool),
+                            np.array(has_decoys, dtype=bool),
+                            *([np.array(values[name], dtype=np.float64) for name in self.record_values] +
+                              [np.array(protein_offsets, dtype=np.int64), np.array(protein_ids, dtype=object)]))
+        if not self.streaming:
+            self.arrays[level] = arrays
+        return arrays
+
+    def get_mask(self, arrays, isDecoy, require_decoy=True):
+        '''Output a boolean array, true for the entries of PoutArrays with the requested decoy status, see is_selected'''
+        if not arrays.hasDecoy.all():
+            # Seems Percolator was run without the -Z flag, so there's no p:decoy attribute
+            if isDecoy == True and require_decoy:
+                sys.exit('KeyError: There might be no p:decoy attribute')
+            return ~arrays.hasDecoy | (arrays.isDecoy == isDecoy)
+        return arrays.isDecoy == isDecoy
+
+    def iter_selected(self, level, names, isDecoy=False):
+        '''Yield tuples of the named values (e.g. id, q_value, protein_ids) of entries with the requested decoy status'''
+        if [name for name in names if name not in PoutRecord._fields]:
+            # Other child elements are read from the xml
+            for element in self.iter_elements(level):
+                record = self.element_to_record(element, level)
+                if self.is_selected(record, isDecoy):
+                    yield tuple(getattr(record, name) if name in PoutRecord._fields else self.child_value(element, name)
+                                for name in names)
+            return
+        if self.streaming and level not in self.arrays:
+            for record in self.iter_records(level):
+                if self.is_selected(record, isDecoy):
+                    yield tuple(getattr(record, name) for name in names)
+            return
+        arrays = self.to_arrays(level)
+        indices = np.flatnonzero(self.get_mask(arrays, isDecoy))
+        columns = []
+        for name in names:
+            if name == 'protein_ids':
+                # Split the flat protein array into one tuple per entry
+                starts = arrays.protein_offsets[indices].tolist()
+                ends = arrays.protein_offsets[indices + 1].tolist()
+                proteins = arrays.protein_ids
+                columns.append([tuple(proteins[start:end]) for start, end in zip(starts, ends)])
+            else:
+                columns.append(getattr(arrays, name)[indices].tolist())
+        for row in zip(*columns):
+            yield row
+
+    def get_column(self, level, name, isDecoy=False, require_decoy=True):
+        '''Output a list of one value (e.g. id, q_value, svm_score) for each psm, peptide or protein'''
+        if self.streaming and level not in self.arrays:
+            return [getattr(record, name) for record in self.iter_records(level)
+                    if self.is_selected(record, isDecoy, require_decoy)]
+        arrays = self.to_arrays(level)
+        return getattr(arrays, name)[self.get_mask(arrays, isDecoy, require_decoy)].tolist()
 
     def get_qvalues(self, level, isDecoy=False):
         '''Output a list of a qvalues of a pout file, for peptides or psms'''
-        qvalues = []
-        for element in self.tree.findall('{%(n)s}%(l)ss/{%(n)s}%(l)s' % dict(n=self.ns, l=level)):
-            try:
-                if (element.attrib['{%s}decoy' % (self.ns)] == 'true') == isDecoy:
-                    qvalue = float(element.find('{%s}q_value' % (self.ns)).text)
-                    qvalues.append(qvalue)
-            except KeyError:
-                # Seems Percolator was run without the -Z flag, so there's no p:decoy attribute
-                if isDecoy == True:
-                    sys.exit('KeyError: There might be no p:decoy attribute')
-                qvalue = float(element.find('{%s}q_value' % (self.ns)).text)
-                qvalues.append(qvalue)
-        return qvalues
+        return self.get_column(level, 'q_value', isDecoy)
 
     def get_psm_ids(self, isDecoy=False):
-        '''Output a list of a qvalues of a pout file, for peptides or psms'''
-        psm_ids = []
-        for element in self.tree.findall('{%s}psms/{%s}psm' % (self.ns, self.ns)):
-            try:
-                if (element.attrib['{%s}decoy' % (self.ns)] == 'true') == isDecoy:
-                    psm_id = element.attrib['{%s}psm_id' % (self.ns)]
-                    psm_ids.append(psm_id)
-            except KeyError:
-                # Seems Percolator was run without the -Z flag, so there's no p:decoy attribute
-                if isDecoy == True:
-                    sys.exit('KeyError: There might be no p:decoy attribute')
-                psm_id = element.attrib['{%s}psm_id' % (self.ns)]
-                psm_ids.append(psm_id)
-        return psm_ids
+        '''Output a list of the psm ids of a pout file'''
+        return self.get_column('psm', 'id', isDecoy)
 
     def get_scores(self, level, isDecoy=False):
         '''Output a list of a scores of a pout file, for peptides or psms'''
-        scores = []
-        for element in self.tree.findall('{%s}%ss/{%s}%s' % (self.ns, level, self.ns, level)):
-            try:
-                if (element.attrib['{%s}decoy' % (self.ns)] == 'true') == isDecoy:
-                    score = float(element.find('{%s}svm_score' % (self.ns)).text)
-                    scores.append(score)
-            except KeyError:
-                # Seems Percolator was run without the -Z flag, so there's no p:decoy attribute
-                score = float(element.find('{%s}svm_score' % (self.ns)).text)
-                scores.append(score)
-        return scores
+        # Without p:decoy attributes, all scores are output
+        return self.get_column(level, 'svm_score', isDecoy, require_decoy=False)
 
     def get_peptides(self, threshold=1, value_name='svm_score', ptms=True, isDecoy=False):
         '''Output dictionary of peptides below the q-value threshold, value_name decides the type of value in dict'''
         peptides = {}
-        for element in self.tree.findall('{%s}peptides/{%s}peptide' % (self.ns, self.ns)):
-            try:
-                if (element.attrib['{%s}decoy' % (self.ns)] == 'true') == isDecoy:
-                    peptide = element.attrib['{%s}peptide_id' % (self.ns)]
-                    # Remove UNIMOD bits, if not considering PTMs
-                    if not ptms:
-                        peptide = self.strip_mods(peptide)
-                    qvalue = float(element.find('{%s}q_value' % (self.ns)).text)
-                    value = float(element.find('{%s}%s' % (self.ns, value_name)).text)
-                    # Add peptide, unless it's already added
-                    if qvalue <= threshold and peptide not in peptides:
-                        peptides[peptide] = value
-            except KeyError:
-                # Seems Percolator was run without the -Z flag, so there's no p:decoy attribute
-                if isDecoy == True:
-                    sys.exit('KeyError: There might be no p:decoy attribute')
-                peptide = element.attrib['{%s}peptide_id' % (self.ns)]
-                # Remove UNIMOD bits, if not considering PTMs
-                if not ptms:
-                    peptide = self.strip_mods(peptide)
-                qvalue = float(element.find('{%s}q_value' % (self.ns)).text)
-                value = float(element.find('{%s}%s' % (self.ns, value_name)).text)
-                # Add peptide, unless it's already added
-                if qvalue <= threshold and peptide not in peptides:
-                    peptides[peptide] = value
+        for peptide, qvalue, value in self.iter_selected('peptide', ('id', 'q_value', value_name), isDecoy):
+            # Remove UNIMOD bits, if not considering PTMs
+            if not ptms:
+                peptide = self.strip_mods(peptide)
+            # Add peptide, unless it's already added
+            if qvalue <= threshold and peptide not in peptides:
+                peptides[peptide] = value
         return peptides
 
     def get_proteins(self, threshold=1, value_name='q_value', isDecoy=False):
         '''Output dictionary of proteins below the q-value threshold, value_name decides the type of value in dict'''
         proteins = {}
-        for element in self.tree.findall('{%s}proteins/{%s}protein' % (self.ns, self.ns)):
-            try:
-                if (element.attrib['{%s}decoy' % (self.ns)] == 'true') == isDecoy:
-                    protein = element.attrib['{%s}protein_id' % (self.ns)]
-                    qvalue = float(element.find('{%s}q_value' % (self.ns)).text)
-                    value = float(element.find('{%s}%s' % (self.ns, value_name)).text)
-                    if qvalue <= threshold:
-                        proteins[protein] = value
-            except KeyError:
-                # Seems Percolator was run without the -Z flag, so there's no p:decoy attribute
-                if isDecoy == True:
-                    sys.exit('KeyError: There might be no p:decoy attribute')
-                protein = element.attrib['{%s}protein_id' % (self.ns)]
-                qvalue = float(element.find('{%s}q_value' % (self.ns)).text)
-                value = float(element.find('{%s}%s' % (self.ns, value_name)).text)
-                if qvalue <= threshold:
-                    proteins[protein] = value
+        for protein, qvalue, value in self.iter_selected('protein', ('id', 'q_value', value_name), isDecoy):
+            if qvalue <= threshold:
+                proteins[protein] = value
         return proteins
 
     def get_peptide_to_protein_dict(self, threshold=1, ptms=True, isDecoy=False):
         '''Output dictionary of peptides to protein dictionary, for those below the q-value threshold'''
-        peptides = {}
-        for element in self.tree.findall('{%s}peptides/{%s}peptide' % (self.ns, self.ns)):
-            proteins = []
-            if (element.attrib['{%s}decoy' % (self.ns)] == 'true') == isDecoy:
-                peptide = element.attrib['{%s}peptide_id' % (self.ns)]
-                # Remove UNIMOD bits, if not considering PTMs
-                if not ptms:
-                    peptide = self.strip_mods(peptide)
-                qvalue = float(element.find('{%s}q_value' % (self.ns)).text)
-                # Get protein_ids
-                for protein_id in element.findall('{%s}protein_id' % (self.ns)):
-                    proteins.append(protein_id.text)
-                # Store peptide, unless it's already stored
-                if qvalue <= threshold and peptide not in peptides:
-                    peptides[peptide] = proteins
-        return peptides
+        return self.get_peptide_protein_map(threshold, ptms, isDecoy).to_dict()
+
+    def get_peptide_protein_map(self, threshold=1, ptms=True, isDecoy=False):
+        '''
+        Output the peptides below the q-value threshold with their proteins, as a read-only PeptideProteinMap,
+        where peptides and proteins also have integer ids.
+        '''
+        if self.streaming and 'peptide' not in self.arrays:
+            peptides, protein_values, starts, ends = [], [], [], []
+            for peptide, qvalue, protein_ids in self.iter_selected('peptide', ('id', 'q_value', 'protein_ids'), isDecoy):
+                if qvalue <= threshold:
+                    peptides.append(peptide)
+                    starts.append(len(protein_values))
+                    protein_values.extend(protein_ids)
+                    ends.append(len(protein_values))
+        else:
+            arrays = self.to_arrays('peptide')
+            indices = np.flatnonzero(self.get_mask(arrays, isDecoy) & (arrays.q_value <= threshold))
+            peptides = arrays.id[indices]
+            protein_values = arrays.protein_ids
+            starts, ends = arrays.protein_offsets[indices], arrays.protein_offsets[indices + 1]
+        # Remove UNIMOD bits, if not considering PTMs
+        if not ptms:
+            peptides = [self.strip_mods(peptide) for peptide in peptides]
+        # A repeated peptide keeps the proteins of its first entry
+        return PeptideProteinMap.from_entries(peptides, starts, ends, protein_values, merge='first')
 
     def strip_mods(self, seq):
         '''Take a peptide sequence, strip all occurences of [UNIMOD:XX]'''
-        seq = seq.replace('[UNIMOD:', '')
-        seq = seq.replace(']', '')
-        seq = ''.join([letter for letter in seq if letter.isalpha()])
-        return seq
+        return parse_mods(seq, self.parsed_mods)[0]
+
+    def parse_mods(self, seq):
+        '''Take a peptide sequence, and output the stripped sequence and a tuple of (position, UNIMOD id), see parse_mods'''
+        return parse_mods(seq, self.parsed_mods)
 
 
 
 class Pin():
     '''Class that reads pin file, takes a pathname as input'''
 
-    def __init__(self, pathname, ns_num=13, is_huge_tree=False):
+    chunk_size = 100000  # Number of psms whose features are converted to floats at once
+
+    def __init__(self, pathname, ns_num=13, is_huge_tree=False, cache=False, cache_path=None):
         '''Initialize with pathname to pin-file'''
+        '''If cache is True, the parsed arrays are stored in (or read from) a sidecar .npz file, see ParseCache'''
         self.pathname = pathname
         self.ns = 'http://per-colator.com/percolator_in/%s' % (ns_num)
-        parser = etree.XMLParser(ns_clean=False, huge_tree=is_huge_tree, remove_blank_text=True)  # Remove blank enables pretty print
-        self.tree = etree.parse(self.pathname, parser)
+        self.is_huge_tree = is_huge_tree
+        self.tree = None
+        self.arrays = None  # PinArrays, filled by to_arrays and emptied when the tree is changed
+        if cache:
+            parse_cache = ParseCache(pathname, 'pin', ns_num, cache_path)
+            columns = parse_cache.load()
+            if columns is not None:
+                self.arrays = pin_arrays_from_columns(columns)
+            else:
+                parse_cache.save(pin_arrays_to_columns(self.to_arrays()))
+        else:
+            self.parse_tree()
+
+    def parse_tree(self):
+        '''Parse the pin-file, unless it has been parsed already'''
+        if self.tree is None:
+            parser = etree.XMLParser(ns_clean=False, huge_tree=self.is_huge_tree, remove_blank_text=True)  # Remove blank enables pretty print
+            self.tree = etree.parse(self.pathname, parser)
+
+    def to_arrays(self):
+        '''
+        Read all psms in one pass, and output a PinArrays with the feature names, a 2-D float64 array (psms x features),
+        and the aligned arrays of psm ids, decoy booleans, peptide sequences, proteins (as offsets plus values)
+        and of the attributes present in all psms. The arrays are kept until the tree is changed.
+        '''
+        if self.arrays is not None:
+            return self.arrays
+        self.parse_tree()
+        feature_names = [element.attrib['name'] for element in
+                         self.tree.findall('{%s}featureDescriptions/{%s}featureDescription' % (self.ns, self.ns))]
+        features_tag = '{%s}features' % (self.ns)
+        peptide_tag = '{%s}peptide' % (self.ns)
+        occurence_tag = '{%s}occurence' % (self.ns)
+        num_features = len(feature_names)
+        psms = self.tree.findall('{%s}fragSpectrumScan/{%s}peptideSpectrumMatch' % (self.ns, self.ns))
+        matrix = np.empty((len(psms), num_features), dtype=np.float64)
+        ids, decoys, sequences, feature_texts, protein_ids = [], [], [], [], []
+        protein_offsets = [0]
+        attributes = None
+        chunk_start = 0  # Index of the first psm whose features are not converted yet
+        for element in psms:
+            ids.append(element.attrib['id'])
+            decoys.append(element.attrib['isDecoy'] == 'true')  # Convert element string boolean to boolean
+            # Only keep the attributes that are present in all psms
+            if attributes is None:
+                attributes = dict((name, []) for name in element.attrib.keys())
+            for name in attributes.keys():
+                if name in element.attrib:
+                    attributes[name].append(element.attrib[name])
+                else:
+                    del attributes[name]
+            for child in element:
+                if child.tag == features_tag:
+                    if len(child) != num_features:
+                        raise ValueError('PSM %s has %d features, expected %d' % (ids[-1], len(child), num_features))
+                    feature_texts.extend([feature.text for feature in child])
+                elif child.tag == peptide_tag:
+                    sequences.append(child[0].text)  # The peptideSequence element
+                elif child.tag == occurence_tag:
+                    protein_ids.append(child.attrib['proteinId'])
+            protein_offsets.append(len(protein_ids))
+            # Let numpy convert the strings to floats a chunk of psms at a time
+            if len(ids) - chunk_start == self.chunk_size or len(ids) == len(psms):
+                matrix[chunk_start:len(ids)] = np.array(feature_texts, dtype=str).reshape(len(ids) - chunk_start,
+                                                                                           num_features)
+                chunk_start, feature_texts = len(ids), []
+        attributes = dict((name, np.array(values, dtype=object)) for name, values in (attributes or {}).items())
+        self.arrays = PinArrays(feature_names, matrix, np.array(ids, dtype=object), np.array(decoys, dtype=bool),
+                                np.array(sequences, dtype=object), np.array(protein_offsets, dtype=np.int64),
+                                np.array(protein_ids, dtype=object), attributes)
+        return self.arrays
 
     def get_feature_names(self):
         '''Output a list of all the feature names in the pin file'''
-        feature_names = []
-        for element in self.tree.findall('{%s}featureDescriptions/{%s}featureDescription' % (self.ns, self.ns)):
-            name = element.attrib['name']
-            feature_names.append(name)
-        return feature_names
+        return list(self.to_arrays().feature_names)
 
     def get_feature_values(self, feature_index, isDecoy=False, type_func=float):
         '''Extract all features values for a given feature, and output a list (first feature has index 0)'''
-        values = []
-        for element in self.tree.findall('{%s}fragSpectrumScan/{%s}peptideSpectrumMatch' % (self.ns, self.ns)):
-            element_isDecoy = element.attrib['isDecoy'] == 'true'  # Convert element string boolean to boolean
-            if isDecoy == element_isDecoy:
-                feature_element = element.findall('{%s}features/{%s}feature' % (self.ns, self.ns))[feature_index]
-                feature_value = feature_element.text
-                values.append(type_func(feature_value))  # type_func: float(), int(), etc...
+        arrays = self.to_arrays()
+        values = arrays.features[arrays.isDecoy == isDecoy, feature_index].tolist()
+        if type_func is not float:
+            values = [type_func(value) for value in values]  # type_func: float(), int(), etc...
         return values
 
+    def get_feature_matrix(self):
+        '''
+        Read all psms in one pass, and output a PinMatrix with a 2-D float64 array (psms x features),
+        and the aligned arrays of psm ids, decoy booleans and peptide sequences
+        '''
+        arrays = self.to_arrays()
+        return PinMatrix(arrays.features, arrays.id, arrays.isDecoy, arrays.sequence)
+
     def get_sequences(self, isDecoy=False):
         '''Extract peptide sequences for each psm, and output these in a list'''
-        sequences = []
-        for element in self.tree.findall('{%s}fragSpectrumScan/{%s}peptideSpectrumMatch' % (self.ns, self.ns)):
-            element_isDecoy = element.attrib['isDecoy'] == 'true'  # Convert element string boolean to boolean
-            if isDecoy == element_isDecoy:
-                sequence = element.find('{%s}peptide/{%s}peptideSequence' % (self.ns, self.ns)).text
-                sequences.append(sequence)
-        return sequences
+        arrays = self.to_arrays()
+        return arrays.sequence[arrays.isDecoy == isDecoy].tolist()
 
     def get_psm_attributes(self, attrib_name, isDecoy=False, type_func=str):
         '''Extract values of the attrib_name attributes of the peptideSpectrumMatch elements'''
+        arrays = self.to_arrays()
+        if attrib_name in arrays.attributes:
+            values = arrays.attributes[attrib_name][arrays.isDecoy == isDecoy].tolist()
+            return [type_func(value) for value in values]  # type_func is the function (float, int, etc.)
+        # The attribute is missing in some psms, so look for it in the tree
+        self.parse_tree()
         attributes = []
         for element in self.tree.findall('{%s}fragSpectrumScan/{%s}peptideSpectrumMatch' % (self.ns, self.ns)):
             element_isDecoy = element.attrib['isDecoy'] == 'true'  # Convert element string boolean to boolean
@@ -201,87 +588,482 @@ class Pin():
 
     def get_peptide_to_protein_dictionary(self, isDecoy=False):
         '''Store the peptides in a directory as keys, with their proteins in lists as values'''
-        peptide_to_protein_dict = {}
-        for element in self.tree.findall('{%s}fragSpectrumScan/{%s}peptideSpectrumMatch' % (self.ns, self.ns)):
-            element_isDecoy = element.attrib['isDecoy'] == 'true'  # Convert element string boolean to boolean
-            if isDecoy == element_isDecoy:
-                peptide = element.find('{%s}peptide/{%s}peptideSequence' % (self.ns, self.ns)).text
-                # Get proteins
-                protein_list = []
-                for occ in element.findall('{%s}occurence' % (self.ns)):
-                    protein_list.append(occ.attrib['proteinId'])
-                # Store proteins in dictionary
-                try:
-                    peptide_to_protein_dict[peptide].extend(protein_list)
-                except KeyError:
-                    peptide_to_protein_dict[peptide] = protein_list
-                # Uniqify
-                peptide_to_protein_dict[peptide] = list(set(peptide_to_protein_dict[peptide]))
-        return peptide_to_protein_dict
+        return self.get_peptide_protein_map(isDecoy).to_dict()
+
+    def get_peptide_protein_map(self, isDecoy=False):
+        '''
+        Output the peptides with their proteins, as a read-only PeptideProteinMap,
+        where peptides and proteins also have integer ids.
+        '''
+        arrays = self.to_arrays()
+        indices = np.flatnonzero(arrays.isDecoy == isDecoy)
+        # The proteins of all psms of a peptide are merged, and uniqified
+        return PeptideProteinMap.from_entries(arrays.sequence[indices], arrays.protein_offsets[indices],
+                                              arrays.protein_offsets[indices + 1], arrays.protein_ids, merge='union')
 
     def remove_features(self, feature_names, add_value_to_ind=None, type_func=float):
-        '''Remove all instances of certain feature(s) from the pin-file'''
+        '''
+        Remove all instances of certain feature(s) from the pin-file, in one pass over the psms.
+        If add_value_to_ind is set, the sum of the removed values is stored in the feature at that index.
+        '''
         # Make a list of the feature if it is only one
-        if type(feature_names) == str:
-            feature_names = [str]
+        if isinstance(feature_names, basestring):
+            feature_names = [feature_names]
         # Find indeces
-        indeces = []
+        self.parse_tree()
+        self.arrays = None
         descriptions = self.tree.find('{%s}featureDescriptions' % (self.ns))
-        for description in descriptions.findall('{%s}featureDescription' % (self.ns)):
-            if description.attrib['name'] in feature_names:
-                indeces.append(descriptions.index(description))
+        names = [description.attrib['name'] for description in descriptions]
+        missing = [name for name in feature_names if name not in names]
+        if missing:
+            raise KeyError('Features not present in pin-file: %s' % (', '.join(missing)))
+        indeces = [i for i, name in enumerate(names) if name in feature_names]
         indeces.sort(reverse=True)
         # Remove feature descriptions
         for i in indeces:
-            descriptions.remove(descriptions[i])
+            del descriptions[i]
         # Remove features from PSM elements
-        for scan in self.tree.findall('{%s}fragSpectrumScan' % (self.ns)):
-            for psm in scan.findall('{%s}peptideSpectrumMatch' % (self.ns)):
-                value = type_func(0)
-                features = psm.find('{%s}features' % (self.ns))
-                for i in indeces:
-                    value += type_func(features[i].text)
-                    features.remove(features[i])
-                if add_value_to_ind is not None:
-                    features[add_value_to_ind].text = str(value)
+        for features in self.tree.findall('{%(n)s}fragSpectrumScan/{%(n)s}peptideSpectrumMatch/{%(n)s}features' % dict(n=self.ns)):
+            value = type_func(0)
+            for i in indeces:
+                value += type_func(features[i].text)
+                del features[i]
+            if add_value_to_ind is not None:
+                features[add_value_to_ind].text = str(value)
 
-    def add_feature(self, feature_name, target_dict, decoy_dict):
-        '''Add a feature to a pin-file, requires dictionaries between psm-id and feature values'''
-        # Add feature name to featureDescriptions
+    def add_features(self, names, values):
+        '''
+        Add features to a pin-file, in one pass over the psms.
+        values is a dictionary from feature name to either a dictionary between psm-id and feature value,
+        or a sequence (e.g. an array) with one feature value per psm, in the order of the pin-file.
+        All values are checked before the pin-file is changed.
+        '''
+        if isinstance(names, basestring):
+            names = [names]
+        existing = self.get_feature_names()
+        duplicates = [name for name in names if name in existing]
+        if duplicates:
+            raise ValueError('Features already present in pin-file: %s' % (', '.join(duplicates)))
+        self.parse_tree()
+        psms = self.tree.findall('{%s}fragSpectrumScan/{%s}peptideSpectrumMatch' % (self.ns, self.ns))
+        columns = [self.feature_column(name, values[name], psms) for name in names]
+        self.arrays = None
+        # Add feature names to featureDescriptions
         feat_descrip = self.tree.find('{%s}featureDescriptions' % (self.ns))
-        new_element = feat_descrip.makeelement('{%s}featureDescription' % (self.ns))
-        new_element.set('name', feature_name)
-        feat_descrip.append(new_element)
+        for name in names:
+            new_element = feat_descrip.makeelement('{%s}featureDescription' % (self.ns))
+            new_element.set('name', name)
+            feat_descrip.append(new_element)
         # Add feature values to PSMs
-        for isDecoy, id_to_value in [(False, target_dict), (True, decoy_dict)]:
-            for psm in self.tree.findall('{%s}fragSpectrumScan/{%s}peptideSpectrumMatch' % (self.ns, self.ns)):
-                element_isDecoy = psm.attrib['isDecoy'] == 'true'  # Convert element string boolean to boolean
-                if isDecoy == element_isDecoy:
-                    psm_id = psm.attrib['id']
-                    try:
-                        feature_value = id_to_value[psm_id]
-                        features = psm.find('{%s}features' % (self.ns))
-                        new_feature = features.makeelement('{%s}feature' % (self.ns))
-                        new_feature.text = str(feature_value)
-                        features.append(new_feature)
-                    except KeyError:
-                        sys.exit('KeyError: %s was not present in id dictionary' % (psm_id))
+        feature_tag = '{%s}feature' % (self.ns)
+        for psm, row in zip(psms, zip(*columns)):
+            features = psm.find('{%s}features' % (self.ns))
+            for feature_value in row:
+                etree.SubElement(features, feature_tag).text = str(feature_value)
+
+    def feature_column(self, name, values, psms):
+        '''Output a list with the feature value of each psm, values is a dictionary from psm-id or a sequence'''
+        if hasattr(values, 'keys'):
+            ids = [psm.attrib['id'] for psm in psms]
+            missing = [psm_id for psm_id in ids if psm_id not in values]
+            if missing:
+                raise KeyError('%d psm ids were not present in the values of feature %s, e.g. %s' %
+                               (len(missing), name, ', '.join(missing[:5])))
+            return [values[psm_id] for psm_id in ids]
+        if len(values) != len(psms):
+            raise ValueError('Feature %s has %d values, but the pin-file has %d psms' % (name, len(values), len(psms)))
+        return list(values)
+
+    def add_feature(self, feature_name, target_dict, decoy_dict):
+        '''Add a feature to a pin-file, requires dictionaries between psm-id and feature values'''
+        values = []
+        missing = []
+        self.parse_tree()
+        for psm in self.tree.findall('{%s}fragSpectrumScan/{%s}peptideSpectrumMatch' % (self.ns, self.ns)):
+            id_to_value = decoy_dict if psm.attrib['isDecoy'] == 'true' else target_dict
+            psm_id = psm.attrib['id']
+            if psm_id in id_to_value:
+                values.append(id_to_value[psm_id])
+            else:
+                missing.append(psm_id)
+        if missing:
+            raise KeyError('%d psm ids were not present in id dictionary, e.g. %s' % (len(missing), ', '.join(missing[:5])))
+        self.add_features([feature_name], {feature_name: values})
 
     def get_ids(self, isDecoy=False):
         '''Extract psm id's output these to list'''
-        ids = []
-        for element in self.tree.findall('{%s}fragSpectrumScan/{%s}peptideSpectrumMatch' % (self.ns, self.ns)):
-            element_isDecoy = element.attrib['isDecoy'] == 'true'  # Convert element string boolean to boolean
-            if isDecoy == element_isDecoy:
-                psm_id = element.attrib['id']
-                ids.append(psm_id)
-        return ids        
+        arrays = self.to_arrays()
+        return arrays.id[arrays.isDecoy == isDecoy].tolist()
 
     def write(self, outpath):
         '''Write the current tree to outpath'''
+        self.parse_tree()
         self.tree.write(outpath, pretty_print=True)
 
 
+class PoutView(Pout):
+    '''The getters of Pout, on top of already parsed PoutArrays (a dictionary from level)'''
+
+    def __init__(self, arrays, pathname=None):
+        self.pathname = pathname
+        self.source = pathname
+        self.arrays = arrays
+        self.streaming = False
+        self.tree = None
+        self.parsed_mods = {}
+
+    def parse_tree(self):
+        '''A view has no xml tree'''
+        raise TypeError('Reading xml elements (e.g. child elements other than %s) needs the xml tree, but only the '
+                        'parsed arrays of %s are available' % (', '.join(self.record_values), self.source))
+
+
+class PinView(Pin):
+    '''The getters of Pin, on top of already parsed PinArrays'''
+
+    def __init__(self, arrays, pathname=None):
+        self.pathname = pathname
+        self.source = pathname
+        self.arrays = arrays
+        self.tree = None
+
+    def parse_tree(self):
+        '''A view has no xml tree'''
+        self.no_tree('Reading xml elements (e.g. attributes missing in some psms)')
+
+    def no_tree(self, operation):
+        '''Raise a TypeError for an operation that needs the xml tree'''
+        raise TypeError('%s needs the xml tree, but only the parsed arrays of %s are available' % (operation, self.source))
+
+    def remove_features(self, *args, **kwargs):
+        '''A view can not be changed'''
+        self.no_tree('remove_features')
+
+    def add_features(self, *args, **kwargs):
+        '''A view can not be changed'''
+        self.no_tree('add_features')
+
+    def add_feature(self, *args, **kwargs):
+        '''A view can not be changed'''
+        self.no_tree('add_feature')
+
+    def write(self, outpath):
+        '''A view can not be written'''
+        self.no_tree('write')
+
+
+def expand_pathnames(patterns):
+    '''Take a glob pattern (or a list of patterns and pathnames), and output the sorted list of matching files'''
+    if isinstance(patterns, basestring):
+        patterns = [patterns]
+    pathnames = []
+    for pattern in patterns:
+        pathnames.extend(sorted(glob.glob(pattern)))
+    if not pathnames:
+        raise IOError('No files found for %s' % (', '.join(patterns)))
+    return pathnames
+
+
+def map_files(function, arguments, processes):
+    '''Apply function to each argument tuple, in a process pool unless processes is 1'''
+    if processes == 1 or len(arguments) == 1:
+        return [function(argument) for argument in arguments]
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(function, arguments, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def concatenate_offsets(offsets_list):
+    '''Concatenate offset arrays (each starting at 0) of consecutive value arrays into one offset array'''
+    shifted = [np.zeros(1, dtype=np.int64)]
+    shift = 0
+    for offsets in offsets_list:
+        shifted.append(offsets[1:] + shift)
+        shift += offsets[-1]
+    return np.concatenate(shifted)
+
+
+def read_pout_arrays(arguments):
+    '''Parse all levels of a pout file, and output a dictionary from level to PoutArrays (used by PoutCollection)'''
+    pathname, levels, kwargs = arguments
+    pout = Pout(pathname, **kwargs)
+    return dict((level, pout.to_arrays(level)) for level in levels)
+
+
+def read_pin_arrays(arguments):
+    '''Parse a pin file, and output its PinArrays (used by PinCollection)'''
+    pathname, kwargs = arguments
+    return Pin(pathname, **kwargs).to_arrays()
+
+
+class PoutCollection(PoutView):
+    '''
+    Class that reads many pout files in parallel, takes a glob pattern (or a list of patterns) as input.
+    The getters of Pout work on the merged arrays of all files, get_run_labels tells which file each value comes from,
+    and get_per_run applies a getter to each file separately. Other arguments are passed on to Pout.
+    '''
+
+    def __init__(self, patterns, processes=None, levels=('psm', 'peptide', 'protein'), **kwargs):
+        self.pathnames = expand_pathnames(patterns)
+        self.streaming = False
+        self.tree = None
+        self.parsed_mods = {}
+        self.pathname = None
+        self.source = 'the collection of %s' % (', '.join(self.pathnames))
+        results = map_files(read_pout_arrays, [(pathname, levels, kwargs) for pathname in self.pathnames], processes)
+        self.runs = dict((pathname, PoutView(arrays, pathname)) for pathname, arrays in zip(self.pathnames, results))
+        # Merge the runs, and remember the run of each entry as an index into self.pathnames
+        self.arrays = {}
+        self.run_indices = {}
+        for level in levels:
+            parts = [arrays[level] for arrays in results]
+            fields = [np.concatenate([getattr(part, field) for part in parts]) for field in PoutArrays._fields]
+            fields[PoutArrays._fields.index('protein_offsets')] = concatenate_offsets([part.protein_offsets for part in parts])
+            self.arrays[level] = PoutArrays(*fields)
+            self.run_indices[level] = np.concatenate([np.repeat(i, len(part.id)) for i, part in enumerate(parts)])
+
+    def get_run_labels(self, level, isDecoy=False):
+        '''Output a list with the pathname of the run of each value, in the order of get_qvalues, get_scores etc.'''
+        arrays = self.to_arrays(level)
+        indices = self.run_indices[level][self.get_mask(arrays, isDecoy)]
+        return [self.pathnames[i] for i in indices.tolist()]
+
+    def get_per_run(self, getter_name, *args, **kwargs):
+        '''Output a dictionary from pathname to the output of a getter (e.g. 'get_peptides') for that run'''
+        return dict((pathname, getattr(run, getter_name)(*args, **kwargs)) for pathname, run in self.runs.items())
+
+
+class PinCollection(PinView):
+    '''
+    Class that reads many pin files in parallel, takes a glob pattern (or a list of patterns) as input.
+    All files must have the same features. The getters of Pin work on the merged arrays of all files,
+    get_run_labels tells which file each psm comes from, and get_per_run applies a getter to each file separately.
+    '''
+
+    def __init__(self, patterns, processes=None, **kwargs):
+        self.pathnames = expand_pathnames(patterns)
+        self.tree = None
+        self.pathname = None
+        self.source = 'the collection of %s' % (', '.join(self.pathnames))
+        results = map_files(read_pin_arrays, [(pathname, kwargs) for pathname in self.pathnames], processes)
+        for pathname, arrays in zip(self.pathnames, results):
+            if arrays.feature_names != results[0].feature_names:
+                raise ValueError('The features of %s differ from those of %s' % (pathname, self.pathnames[0]))
+        self.runs = dict((pathname, PinView(arrays, pathname)) for pathname, arrays in zip(self.pathnames, results))
+        # Merge the runs, only keeping the attributes present in all of them
+        fields = [results[0].feature_names]
+        for field in ('features', 'id', 'isDecoy', 'sequence'):
+            fields.append(np.concatenate([getattr(arrays, field) for arrays in results]))
+        fields.append(concatenate_offsets([arrays.protein_offsets for arrays in results]))
+        fields.append(np.concatenate([arrays.protein_ids for arrays in results]))
+        names = set.intersection(*[set(arrays.attributes) for arrays in results])
+        fields.append(dict((name, np.concatenate([arrays.attributes[name] for arrays in results])) for name in names))
+        self.arrays = PinArrays(*fields)
+        self.run_indices = np.concatenate([np.repeat(i, len(arrays.id)) for i, arrays in enumerate(results)])
+
+    def get_run_labels(self, isDecoy=False):
+        '''Output a list with the pathname of the run of each psm, in the order of get_ids, get_feature_values etc.'''
+        indices = self.run_indices[self.arrays.isDecoy == isDecoy]
+        return [self.pathnames[i] for i in indices.tolist()]
+
+    def get_per_run(self, getter_name, *args, **kwargs):
+        '''Output a dictionary from pathname to the output of a getter (e.g. 'get_ids') for that run'''
+        return dict((pathname, getattr(run, getter_name)(*args, **kwargs)) for pathname, run in self.runs.items())
+
+
+class DropFeatures():
+    '''Pin transform that drops features, optionally storing the sum of the dropped values in feature merge_into'''
+
+    def __init__(self, feature_names, merge_into=None, type_func=float):
+        if isinstance(feature_names, basestring):
+            feature_names = [feature_names]
+        self.feature_names = feature_names
+        self.merge_into = merge_into
+        self.type_func = type_func
+
+    def transform_names(self, names):
+        '''Take the list of feature names, and output the list after the transform'''
+        missing = [name for name in self.feature_names if name not in names]
+        if missing:
+            raise KeyError('Features not present in pin-file: %s' % (', '.join(missing)))
+        self.indeces = sorted([i for i, name in enumerate(names) if name in self.feature_names], reverse=True)
+        names = [name for name in names if name not in self.feature_names]
+        if self.merge_into is not None:
+            self.merge_index = names.index(self.merge_into)
+        return names
+
+    def transform_psm(self, psm, features):
+        '''Drop the features of a psm element, output True to keep the psm'''
+        value = self.type_func(0)
+        for i in self.indeces:
+            value += self.type_func(features[i].text)
+            del features[i]
+        if self.merge_into is not None:
+            features[self.merge_index].text = str(value)
+        return True
+
+
+class AddFeatures():
+    '''Pin transform that adds features, takes a dictionary from feature name to a dictionary between psm-id and value'''
+
+    def __init__(self, feature_names, values):
+        if isinstance(feature_names, basestring):
+            feature_names = [feature_names]
+        self.feature_names = feature_names
+        self.values = values
+
+    def transform_names(self, names):
+        '''Take the list of feature names, and output the list after the transform'''
+        duplicates = [name for name in self.feature_names if name in names]
+        if duplicates:
+            raise ValueError('Features already present in pin-file: %s' % (', '.join(duplicates)))
+        return names + list(self.feature_names)
+
+    def transform_psm(self, psm, features):
+        '''Add the features to a psm element, output True to keep the psm'''
+        psm_id = psm.attrib['id']
+        feature_tag = features.tag[:-1]  # The namespaced tag of a feature, from the one of features
+        for name in self.feature_names:
+            try:
+                feature_value = self.values[name][psm_id]
+            except KeyError:
+                raise KeyError('%s was not present in the values of feature %s' % (psm_id, name))
+            etree.SubElement(features, feature_tag).text = str(feature_value)
+        return True
+
+
+class FilterPsms():
+    '''Pin transform that only keeps the psm elements for which predicate(psm) is True'''
+
+    def __init__(self, predicate):
+        self.predicate = predicate
+
+    def transform_names(self, names):
+        '''Take the list of feature names, and output the list after the transform'''
+        return names
+
+    def transform_psm(self, psm, features):
+        '''Output True to keep the psm'''
+        return self.predicate(psm)
+
+
+class BackgroundWriter():
+    '''File-like object that writes to an open file in a separate thread, so that parsing overlaps with writing'''
+
+    def __init__(self, outfile, max_chunks=256):
+        self.outfile = outfile
+        self.queue = Queue.Queue(max_chunks)  # Bounded, so the memory stays flat if the disk is slow
+        self.error = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        '''Write chunks from the queue until None is received'''
+        while True:
+            data = self.queue.get()
+            if data is None:
+                break
+            if self.error is None:
+                try:
+                    self.outfile.write(data)
+                except Exception as error:
+                    self.error = error  # Raised in the main thread by write or close
+
+    def write(self, data):
+        '''Queue data for writing'''
+        if self.error is not None:
+            raise self.error
+        self.queue.put(data)
+
+    def close(self):
+        '''Wait for the queued data to be written, and close the file'''
+        self.queue.put(None)
+        self.thread.join()
+        self.outfile.close()
+        if self.error is not None:
+            raise self.error
+
+
+def namespace_declarations(nsmap):
+    '''Output the xmlns attributes (as serialized by lxml) of a dictionary from prefix to namespace'''
+    return [' xmlns="%s"' % (uri) if prefix is None else ' xmlns:%s="%s"' % (prefix, uri) for prefix, uri in nsmap.items()]
+
+
+def tostring_in_root(element, declarations):
+    '''Serialize an element without the namespace declarations that its root already has (see namespace_declarations)'''
+    data = etree.tostring(element, encoding='UTF-8', xml_declaration=False, with_tail=False)
+    end = data.index('>')  # lxml escapes > in attribute values, so this ends the start tag
+    start_tag = data[:end]
+    for declaration in declarations:
+        start_tag = start_tag.replace(declaration, '', 1)
+    return start_tag + data[end:]
+
+
+def rewrite_pin(inpath, outpath, transforms, ns_num=13, is_huge_tree=False):
+    '''
+    Stream a pin file to outpath, applying a list of transforms (e.g. DropFeatures, AddFeatures, FilterPsms)
+    to the feature descriptions and to each psm, in order. Only one fragSpectrumScan is held in memory at a time.
+    The file is written to a temporary path and renamed when done, so a failing transform leaves no partial file.
+    '''
+    ns = 'http://per-colator.com/percolator_in/%s' % (ns_num)
+    descriptions_tag = '{%s}featureDescriptions' % (ns)
+    scan_tag = '{%s}fragSpectrumScan' % (ns)
+    features_tag = '{%s}features' % (ns)
+    events = etree.iterparse(inpath, events=('start', 'end'), huge_tree=is_huge_tree)
+    event, root = next(events)
+    # The children are serialized without the namespace declarations of the root
+    declarations = namespace_declarations(root.nsmap)
+    shell = etree.Element(root.tag, dict(root.attrib), nsmap=root.nsmap)
+    shell.text = '\n'
+    root_start, root_end = etree.tostring(shell, encoding='UTF-8', xml_declaration=False).split('\n')
+    temporary_path = '%s.%d.tmp' % (outpath, os.getpid())
+    writer = BackgroundWriter(open(temporary_path, 'wb'))
+    finished = False
+    try:
+        writer.write("<?xml version='1.0' encoding='UTF-8'?>\n%s\n" % (root_start))
+        for event, element in events:
+            # Only handle the children of the root, when they are complete
+            if event != 'end' or element.getparent() is not root:
+                continue
+            if element.tag == descriptions_tag:
+                old_descriptions = dict((description.attrib['name'], description) for description in element)
+                names = [description.attrib['name'] for description in element]
+                for transform in transforms:
+                    names = transform.transform_names(names)
+                # Keep the old elements (with any extra attributes) of the remaining features
+                for description in list(element):
+                    element.remove(description)
+                for name in names:
+                    if name in old_descriptions:
+                        element.append(old_descriptions[name])
+                    else:
+                        etree.SubElement(element, '{%s}featureDescription' % (ns)).set('name', name)
+            elif element.tag == scan_tag:
+                for psm in list(element):
+                    features = psm.find(features_tag)
+                    if not all(transform.transform_psm(psm, features) for transform in transforms):
+                        element.remove(psm)
+            # Write the element unless it is a scan without psms, then free it
+            if element.tag != scan_tag or len(element) > 0:
+                writer.write('%s\n' % (tostring_in_root(element, declarations)))
+            element.clear()
+            while element.getprevious() is not None:
+                del root[0]
+        writer.write(root_end)
+        finished = True
+    finally:
+        try:
+            writer.close()
+        finally:
+            if not finished:
+                os.remove(temporary_path)
+    os.rename(temporary_path, outpath)
+
+
 def main():
     print "This is a module with a few functions for parsing percolator xml files"
 
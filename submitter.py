@@ -5,6 +5,7 @@ import os
 import glob
 import numpy as np
 import random
+import parse_fasta
 
 
 class Local():
@@ -77,6 +78,16 @@ class Search_engine():
             if value == None:
                 sys.exit('Error: Parameter %s not set, required by search engine' % names[i])
 
+    def make_decoy_database(self, decoy_path=None, method='reverse', seed=1):
+        '''Write the decoys of the target database with parse_fasta.write_decoy_database, and use them as decoys'''
+        if self.target_database is None:
+            sys.exit('Error: Parameter target_database not set, required to make the decoy database')
+        if decoy_path is None:
+            root = self.target_database[:-3] if self.target_database.endswith('.gz') else self.target_database
+            decoy_path = '%s_decoy.fasta' % (os.path.splitext(root)[0])
+        parse_fasta.write_decoy_database(self.target_database, decoy_path, method=method, seed=seed)
+        self.decoy_database = decoy_path
+
     def prepare_jobs(self):
         '''Counts how many cores, and prepare that many jobs'''
         jobs = []